@@ -0,0 +1,571 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'JiaSong'
+
+# 基于非阻塞socket和epoll/poll事件循环的HTTP客户端，单线程即可同时进行大量请求
+# head/get/post/json_request返回AsyncResult，调用wait/run驱动事件循环
+
+import collections
+import errno
+import heapq
+import httplib
+import itertools
+import json
+import select
+import socket
+import StringIO
+import time
+import urlparse
+import logger
+from HttpClient import HttpClient, MAX_READ_LEN, MAX_REDIRECTIONS, USER_AGENT
+
+DEFAULT_MAX_PER_HOST = 100      # 每个host:port最多同时打开的连接数
+DEFAULT_IDLE_TIMEOUT = 60       # 空闲连接超过该时间(秒)关闭
+RECV_LEN = 64 * 1024
+TIMER_COMPACT_MIN = 1024        # 超时堆超过该长度且失效项过半时重建
+
+_EV_READ = getattr(select, 'EPOLLIN', getattr(select, 'POLLIN', 1))
+_EV_WRITE = getattr(select, 'EPOLLOUT', getattr(select, 'POLLOUT', 4))
+_EV_ERROR = getattr(select, 'EPOLLERR', getattr(select, 'POLLERR', 8)) | \
+    getattr(select, 'EPOLLHUP', getattr(select, 'POLLHUP', 16))
+
+
+class AsyncResult(object):
+    '''异步请求结果，请求完成后通过result()获取(status_code, rsp_body)元组'''
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        '''返回请求结果，请求未完成时抛出RuntimeError'''
+        if not self._done:
+            raise RuntimeError('Request not finished yet')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def add_done_callback(self, func):
+        '''请求完成后调用func(async_result)'''
+        if self._done:
+            func(self)
+        else:
+            self._callbacks.append(func)
+
+    def _set_result(self, result=None, exception=None):
+        self._done = True
+        self._result, self._exception = result, exception
+        for func in self._callbacks:
+            try:
+                func(self)
+            except Exception as e:
+                logger.error('Callback exception: {}'.format(e), logtrace=True)
+        self._callbacks = []
+
+
+class _Poller(object):
+    '''epoll/poll/select的统一封装，超时时间单位为秒'''
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._impl, self._scale = select.epoll(), 1.0
+        elif hasattr(select, 'poll'):
+            self._impl, self._scale = select.poll(), 1000.0
+        else:
+            self._impl, self._rfds, self._wfds = None, set(), set()
+
+    def register(self, fd, events):
+        if self._impl is not None:
+            self._impl.register(fd, events)
+        else:
+            self.modify(fd, events)
+
+    def modify(self, fd, events):
+        if self._impl is not None:
+            return self._impl.modify(fd, events)
+        (self._rfds.add if events & _EV_READ else self._rfds.discard)(fd)
+        (self._wfds.add if events & _EV_WRITE else self._wfds.discard)(fd)
+
+    def unregister(self, fd):
+        if self._impl is not None:
+            self._impl.unregister(fd)
+        else:
+            self._rfds.discard(fd)
+            self._wfds.discard(fd)
+
+    def poll(self, timeout):
+        if self._impl is not None:
+            if timeout is None:
+                timeout = -1
+            else:
+                timeout = timeout * self._scale if self._scale == 1.0 else int(timeout * self._scale)
+            try:
+                return self._impl.poll(timeout)
+            except (IOError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+        rfds, wfds, _ = select.select(self._rfds, self._wfds, [], timeout)
+        events = collections.defaultdict(int)
+        for fd in rfds:
+            events[fd] |= _EV_READ
+        for fd in wfds:
+            events[fd] |= _EV_WRITE
+        return events.items()
+
+
+class _Request(object):
+    def __init__(self, method, url, headers, body, timeout, log_req):
+        self.method = method
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.timeout = timeout
+        self.log_req = log_req
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.result = AsyncResult()
+        self.redirects = 0
+        self.retried = False
+        self.finished = False   # 已完成、超时或被重定向后的请求接替
+        self.conn = None        # 最近一次处理该请求的连接
+
+        parts = urlparse.urlsplit(url)
+        if parts.scheme.lower() != 'http':
+            # 非阻塞连接只实现了明文HTTP，https请使用HttpClient
+            raise ValueError('Unsupported URL scheme {!r} for AsyncHttpClient: {}'.format(parts.scheme, url))
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.key = (self.host, self.port)
+        selector = parts.path or '/'
+        if parts.query:
+            selector = '{}?{}'.format(selector, parts.query)
+
+        hdrs = dict(headers)
+        hdrs.setdefault('Host', parts.netloc)
+        hdrs.setdefault('User-agent', USER_AGENT)
+        if body is not None:
+            hdrs.setdefault('Content-type', 'application/x-www-form-urlencoded')
+            hdrs['Content-length'] = str(len(body))
+        lines = ['{} {} HTTP/1.1'.format(method, selector)]
+        lines.extend('{}: {}'.format(k, v) for k, v in hdrs.items())
+        self.raw = '\r\n'.join(lines) + '\r\n\r\n' + (body or '')
+
+
+class _Connection(object):
+    '''非阻塞的HTTP/1.1长连接，一次处理一个请求'''
+
+    def __init__(self, client, key, addr):
+        self.client = client
+        self.key = key
+        self.req = None
+        self.reused = False
+        self.last_used = time.time()
+        self.timer = False      # 是否已在空闲超时堆中
+        self.sock = socket.socket(addr[0], addr[1], addr[2])
+        self.fd = self.sock.fileno()
+        self.connected = False
+        try:
+            self.sock.setblocking(0)
+            err = self.sock.connect_ex(addr[4])
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise socket.error(err, errno.errorcode.get(err, ''))
+        except Exception:
+            self.sock.close()
+            raise
+
+    def start(self, req):
+        self.req = req
+        req.conn = self
+        self.wbuf = req.raw
+        self.rbuf = ''
+        self.state = 'head'
+        self.status, self.reason, self.hdrs = -1, '', None
+        self.body = []
+        self.remain = 0
+        self.keep_alive = True
+        self.got_data = False
+
+    def on_writable(self):
+        if not self.connected:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, errno.errorcode.get(err, ''))
+            self.connected = True
+        sent = self.sock.send(self.wbuf)
+        self.wbuf = self.wbuf[sent:]
+        return not self.wbuf
+
+    def on_readable(self):
+        '''读取并解析响应，响应完整时返回True'''
+        data = self.sock.recv(RECV_LEN)
+        if not data:
+            if self.state == 'close':
+                self.keep_alive = False
+                return True
+            raise socket.error(errno.ECONNRESET, 'Connection closed by peer')
+        self.got_data = True
+        self.rbuf += data
+        return self._parse()
+
+    def _parse(self):
+        if self.state == 'head':
+            pos = self.rbuf.find('\r\n\r\n')
+            if pos < 0:
+                return False
+            head, self.rbuf = self.rbuf[:pos], self.rbuf[pos + 4:]
+            lines = head.split('\r\n')
+            version, _, rest = lines[0].partition(' ')
+            code, _, self.reason = rest.partition(' ')
+            self.status = int(code)
+            self.hdrs = httplib.HTTPMessage(StringIO.StringIO('\r\n'.join(lines[1:]) + '\r\n\r\n'))
+            conn_hdr = (self.hdrs.get('Connection') or '').lower()
+            self.keep_alive = 'close' not in conn_hdr and \
+                (version != 'HTTP/1.0' or 'keep-alive' in conn_hdr)
+            if self.req.method == 'HEAD' or self.status in (204, 304) or 100 <= self.status < 200:
+                self.state = 'done'
+            elif 'chunked' in (self.hdrs.get('Transfer-Encoding') or '').lower():
+                self.state = 'chunk_size'
+            elif self.hdrs.get('Content-Length') is not None:
+                self.state, self.remain = 'length', int(self.hdrs.get('Content-Length'))
+            else:
+                self.state, self.keep_alive = 'close', False
+
+        if self.state == 'length':
+            data, self.rbuf = self.rbuf[:self.remain], self.rbuf[self.remain:]
+            self.body.append(data)
+            self.remain -= len(data)
+            if self.remain == 0:
+                self.state = 'done'
+        elif self.state == 'close':
+            self.body.append(self.rbuf)
+            self.rbuf = ''
+        while self.state.startswith('chunk'):
+            if self.state == 'chunk_size':
+                pos = self.rbuf.find('\r\n')
+                if pos < 0:
+                    return False
+                size = int(self.rbuf[:pos].split(';')[0], 16)
+                self.rbuf = self.rbuf[pos + 2:]
+                self.state, self.remain = ('chunk_data', size) if size else ('chunk_trailer', 0)
+            elif self.state == 'chunk_data':
+                if len(self.rbuf) < self.remain + 2:
+                    return False
+                self.body.append(self.rbuf[:self.remain])
+                self.rbuf = self.rbuf[self.remain + 2:]
+                self.state = 'chunk_size'
+            else:
+                pos = self.rbuf.find('\r\n')
+                if pos < 0:
+                    return False
+                line, self.rbuf = self.rbuf[:pos], self.rbuf[pos + 2:]
+                if not line:
+                    self.state = 'done'
+        return self.state == 'done'
+
+    def close(self):
+        self.sock.close()
+
+
+class AsyncHttpClient(HttpClient):
+    '''
+    异步HTTP客户端，接口与HttpClient一致，但head/get/post/json_request立即返回AsyncResult
+    使用非阻塞socket和长连接，由wait/run在当前线程中驱动事件循环
+    只支持http，https等其他协议的url抛出ValueError，重定向到其他协议时结果为(-1, None)
+
+    Example:
+        client = AsyncHttpClient()
+        results = [client.get(url) for url in urls]
+        for status_code, rsp_body in client.wait(*results):
+            ...
+    '''
+
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST, idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=None):
+        '''
+        max_per_host - 每个host:port最多同时打开的连接数
+        idle_timeout - 空闲连接超时时间(秒)
+        timeout - 请求超时时间(秒)，默认不超时
+        '''
+        HttpClient.__init__(self, keep_alive=False, timeout=timeout)
+        self.max_per_host = max(int(max_per_host), 1)
+        self.idle_timeout = idle_timeout
+        self._poller = _Poller()
+        self._pending = collections.defaultdict(collections.deque)  # key -> 等待连接的请求
+        self._idle = collections.defaultdict(list)   # key -> 空闲连接
+        self._idle_fds = {}  # fd -> 空闲连接
+        self._nconns = collections.defaultdict(int)  # key -> 已打开的连接数
+        self._active = {}  # fd -> 正在处理请求的连接
+        self._timers = []  # (超时时间, 序号, 请求或空闲连接)的最小堆，失效的项在弹出时忽略
+        self._seq = itertools.count()
+        self._addrs = {}   # DNS解析缓存
+        self._inflight = 0
+
+    def head(self, url, headers=None, body=None, xauth=None):
+        '''发起HEAD请求，返回AsyncResult，结果为(status_code, rsp_body)元组'''
+        return self._submit('HEAD', url, headers, body, xauth)
+
+    def get(self, url, headers=None, body=None, xauth=None):
+        '''发起GET请求，返回AsyncResult，结果为(status_code, rsp_body)元组'''
+        return self._submit('GET', url, headers, body, xauth)
+
+    def post(self, url, headers=None, body=None, xauth=None):
+        '''发起POST请求，返回AsyncResult，结果为(status_code, rsp_body)元组'''
+        return self._submit('POST', url, headers, body, xauth)
+
+    def json_request(self, url, method='POST', json_data=None, headers=None, xauth=None):
+        '''发起json格式的请求，返回AsyncResult，结果为(status_code, json对象)元组'''
+        headers = headers or {}
+        headers['Accept'] = headers.get('Accept', 'application/json')
+        headers['Content-Type'] = headers.get('Content-Type', 'application/json; charset=UTF-8')
+
+        body = json.dumps(json_data) if type(json_data) in (dict, list) else (json_data or '')
+        raw = self._submit(method, url, headers, body, xauth)
+        result = AsyncResult()
+
+        def on_done(r):
+            try:
+                status_code, rsp_body = r.result()
+                result._set_result((status_code, json.loads(rsp_body or '')))
+            except Exception as e:
+                result._set_result(exception=e)
+        raw.add_done_callback(on_done)
+        return result
+
+    def wait(self, *results, **kwargs):
+        '''
+        驱动事件循环直到给定的请求全部完成，按顺序返回与参数一一对应的结果列表
+        timeout关键字参数为最长等待时间(秒)，超时后未完成的请求继续保留，其结果位置为None
+        '''
+        timeout = kwargs.get('timeout')
+        deadline = None if timeout is None else time.time() + timeout
+        while not all(r.done() for r in results):
+            if deadline is not None and time.time() >= deadline:
+                break
+            self._run_once(deadline)
+        return [r.result() if r.done() else None for r in results]
+
+    def run(self, timeout=None):
+        '''驱动事件循环直到所有请求完成'''
+        deadline = None if timeout is None else time.time() + timeout
+        while self._inflight:
+            if deadline is not None and time.time() >= deadline:
+                break
+            self._run_once(deadline)
+
+    def close(self):
+        '''关闭所有连接'''
+        for conns in self._idle.values():
+            for conn in conns:
+                self._drop(conn)
+        self._idle.clear()
+        self._idle_fds.clear()
+
+    def _submit(self, method, url, headers, body, xauth, timeout=None):
+        req = self._build_request(method, url, headers, body, xauth)
+        timeout = timeout if timeout is not None else self.timeout
+        areq = _Request(method, url, dict(req.header_items()), body, timeout, req)
+        self._inflight += 1
+        self._enqueue(areq)
+        return areq.result
+
+    def _enqueue(self, areq):
+        if areq.deadline is not None:
+            self._add_timer(areq.deadline, areq)
+        self._pending[areq.key].append(areq)
+        self._dispatch(areq.key)
+
+    def _add_timer(self, deadline, obj):
+        if len(self._timers) > max(TIMER_COMPACT_MIN, 2 * (self._inflight + len(self._idle_fds))):
+            # 已完成请求的项只在到期时才会弹出，请求量大时先清理一次
+            self._timers = [t for t in self._timers if not (isinstance(t[2], _Request) and t[2].finished)]
+            heapq.heapify(self._timers)
+        heapq.heappush(self._timers, (deadline, next(self._seq), obj))
+
+    def _dispatch(self, key):
+        pending, idle = self._pending[key], self._idle[key]
+        while pending and (idle or self._nconns[key] < self.max_per_host):
+            areq = pending.popleft()
+            if areq.finished:
+                # 在等待连接时已超时
+                continue
+            try:
+                if idle:
+                    conn = idle.pop()
+                    del self._idle_fds[conn.fd]
+                    conn.reused = True
+                    self._poller.modify(conn.fd, _EV_WRITE | _EV_ERROR)
+                else:
+                    conn = _Connection(self, key, self._resolve(key))
+                    self._nconns[key] += 1
+                    self._poller.register(conn.fd, _EV_WRITE | _EV_ERROR)
+            except Exception as e:
+                # 与HttpClient一致：DNS解析、建立连接失败时记录日志，结果为(-1, None)
+                logger.error('Exception: {}'.format(e), logtrace=False)
+                self._finish(areq, (-1, None))
+                continue
+            conn.start(areq)
+            self._active[conn.fd] = conn
+
+    def _resolve(self, key):
+        addr = self._addrs.get(key)
+        if addr is None:
+            addr = socket.getaddrinfo(key[0], key[1], 0, socket.SOCK_STREAM)[0]
+            self._addrs[key] = addr
+        return addr
+
+    def _run_once(self, deadline=None):
+        if not self._active:
+            wait = 0
+        else:
+            timeouts = [self._timers[0][0]] if self._timers else []
+            if deadline is not None:
+                timeouts.append(deadline)
+            wait = max(min(timeouts) - time.time(), 0) if timeouts else None
+        for fd, events in self._poller.poll(wait):
+            conn = self._active.get(fd)
+            if conn is None:
+                self._drop_idle(fd)
+                continue
+            try:
+                if events & _EV_WRITE:
+                    if conn.on_writable():
+                        self._poller.modify(fd, _EV_READ | _EV_ERROR)
+                elif events & (_EV_READ | _EV_ERROR):
+                    if conn.on_readable():
+                        self._on_response(conn)
+            except (socket.error, ValueError) as e:
+                if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                self._on_conn_error(conn, e)
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, obj = heapq.heappop(self._timers)
+            if isinstance(obj, _Request):
+                self._expire_request(obj)
+            else:
+                self._expire_idle(obj, now)
+
+    def _expire_request(self, areq):
+        if areq.finished:
+            return
+        conn = areq.conn
+        if conn is not None and conn.req is areq and self._active.get(conn.fd) is conn:
+            self._on_conn_error(conn, socket.timeout('timed out'), retry=False)
+        else:
+            # 仍在等待连接，从等待队列中取出时跳过
+            logger.error('Exception: timed out waiting for connection to {}:{}'.format(*areq.key), logtrace=False)
+            self._finish(areq, (-1, None))
+
+    def _expire_idle(self, conn, now):
+        conn.timer = False
+        if self._idle_fds.get(conn.fd) is not conn:
+            return
+        expire = conn.last_used + self.idle_timeout
+        if expire > now:
+            # 超时前又被使用过，按最近一次使用时间重新计时
+            conn.timer = True
+            self._add_timer(expire, conn)
+            return
+        del self._idle_fds[conn.fd]
+        self._idle[conn.key].remove(conn)
+        self._drop(conn)
+
+    def _on_response(self, conn):
+        areq = conn.req
+        status_code, reason, hdrs, rsp_body = conn.status, conn.reason, conn.hdrs, ''.join(conn.body)
+        del self._active[conn.fd]
+        if conn.keep_alive:
+            conn.req, conn.last_used = None, time.time()
+            self._poller.modify(conn.fd, _EV_READ | _EV_ERROR)
+            self._idle[conn.key].append(conn)
+            self._idle_fds[conn.fd] = conn
+            if self.idle_timeout is not None and not conn.timer:
+                conn.timer = True
+                self._add_timer(conn.last_used + self.idle_timeout, conn)
+        else:
+            self._drop(conn)
+        self._dispatch(conn.key)
+
+        location = hdrs.get('Location')
+        if status_code in (301, 302, 303, 307) and location and areq.redirects < MAX_REDIRECTIONS and \
+                (areq.method in ('GET', 'HEAD') or (status_code != 307 and areq.method == 'POST')):
+            method, body, headers = areq.method, areq.body, areq.headers
+            if method == 'POST':
+                method, body = 'GET', None
+                headers = dict((k, v) for k, v in headers.items()
+                               if k.lower() not in ('content-type', 'content-length'))
+            try:
+                new_req = _Request(method, urlparse.urljoin(areq.url, location), headers, body,
+                                   areq.timeout, areq.log_req)
+            except ValueError, e:
+                logger.error('Redirect error: {}'.format(e), logtrace=False)
+                self._finish(areq, (-1, None))
+                return
+            new_req.result, new_req.redirects = areq.result, areq.redirects + 1
+            areq.finished = True    # 由new_req接替，原请求的超时不再生效
+            self._enqueue(new_req)
+            return
+
+        if status_code >= 400:
+            logger.error(
+                'HTTP request error:\n{} {}\r\n{}'.format(status_code, reason, hdrs), logtrace=False)
+            self._finish(areq, (-1, None))
+            return
+
+        ctype = hdrs.get('Content-Type', '')
+        if ctype.startswith('text') or 'application/json' in ctype:
+            rsp_body = rsp_body[:MAX_READ_LEN]
+        else:
+            rsp_body = None
+            logger.info('Http client not read http body yet.')
+        logger.debug('Response:\n%s\r\n\r\n%s', hdrs, rsp_body)
+        self._finish(areq, (status_code, rsp_body))
+
+    def _on_conn_error(self, conn, e, retry=True):
+        areq = conn.req
+        del self._active[conn.fd]
+        self._drop(conn)
+        if retry and conn.reused and not conn.got_data and not areq.retried:
+            # 复用的连接已被对端关闭，新建连接重试一次
+            areq.retried = True
+            self._pending[areq.key].appendleft(areq)
+            self._dispatch(areq.key)
+            return
+        self._dispatch(conn.key)
+        logger.error('Exception: {}'.format(e), logtrace=False)
+        self._finish(areq, (-1, None))
+
+    def _finish(self, areq, result=None, exception=None):
+        areq.finished = True
+        self._inflight -= 1
+        areq.result._set_result(result, exception)
+
+    def _drop(self, conn):
+        try:
+            self._poller.unregister(conn.fd)
+        except (KeyError, IOError, ValueError):
+            pass
+        conn.close()
+        self._nconns[conn.key] -= 1
+
+    def _drop_idle(self, fd):
+        '''空闲连接可读说明对端已关闭，关闭该连接'''
+        conn = self._idle_fds.pop(fd, None)
+        if conn is None:
+            return
+        self._idle[conn.key].remove(conn)
+        self._drop(conn)
+        self._dispatch(conn.key)
+
+
+if __name__ == '__main__':
+    client = AsyncHttpClient()
+    url = client.get_url('192.168.199.149', 6610, 'nginx-status')
+    results = [client.get(url) for _ in range(10)]
+    for r in client.wait(*results):
+        print r
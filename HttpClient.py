@@ -2,13 +2,385 @@
 # -*- coding: utf-8 -*-
 __author__ = 'JiaSong'
 
+import urllib
 import urllib2
+import urlparse
+import httplib
+import socket
+import select
+import threading
+import Queue
+import time
 import json
 import md5
 import re
 import logger
 
 MAX_READ_LEN = 4096
+STREAM_CHUNK_LEN = 64 * 1024    # 流式读取时的默认块大小
+MAX_DRAIN_LEN = 64 * 1024       # 归还连接前最多丢弃的未读消息体长度
+MAX_REDIRECTIONS = 10           # 与urllib2保持一致
+DEFAULT_POOL_MAXSIZE = 10       # 每个host:port最多缓存的空闲连接数
+DEFAULT_POOL_IDLE_TIMEOUT = 60  # 空闲连接超过该时间(秒)不再复用
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+JSON_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+USER_AGENT = 'Python-urllib/%s' % urllib2.__version__
+# urllib2.build_opener默认安装的handler，opener中出现其他handler时认为用户做了定制
+DEFAULT_HANDLERS = tuple(getattr(urllib2, name) for name in (
+    'ProxyHandler', 'UnknownHandler', 'HTTPHandler', 'HTTPDefaultErrorHandler', 'HTTPRedirectHandler',
+    'FTPHandler', 'FileHandler', 'HTTPErrorProcessor', 'HTTPSHandler') if hasattr(urllib2, name))
+
+
+def _need_urllib2(url):
+    '''
+    url需要经过代理(http_proxy等环境变量，no_proxy除外)，或已通过urllib2.install_opener安装了
+    定制的opener(自定义handler、显式代理)时返回True，此时连接池无法保证与urllib2行为一致
+    '''
+    parts = urlparse.urlsplit(url)
+    if (parts.scheme or 'http') in urllib.getproxies() and not urllib.proxy_bypass(parts.netloc):
+        return True
+    opener = urllib2._opener
+    if opener is None:
+        return False
+    for handler in opener.handlers:
+        if handler.__class__ not in DEFAULT_HANDLERS:
+            return True
+        if isinstance(handler, urllib2.ProxyHandler) and handler.proxies:
+            return True
+    return False
+
+
+class ConnectionPool(object):
+    '''
+    按(scheme, host, port)缓存HTTP/1.1长连接的连接池
+    从池中取连接时做健康检查：空闲超时或对端已关闭(socket可读)的连接直接丢弃
+    '''
+
+    def __init__(self, maxsize=DEFAULT_POOL_MAXSIZE, idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        '''
+        maxsize - 每个host:port最多缓存的空闲连接数
+        idle_timeout - 空闲连接超时时间(秒)，为None时不检查
+        timeout - 取连接时未指定超时时使用的默认超时时间(秒)，默认使用socket全局超时
+        '''
+        self.maxsize = max(int(maxsize), 1)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.hits = 0       # 复用已有连接的次数
+        self.misses = 0     # 新建连接的次数
+        self.discards = 0   # 因不健康或池满被关闭的连接数
+        self._idle = {}     # key -> [(conn, last_used), ...]
+        self._lock = threading.Lock()
+
+    def get(self, scheme, host, port, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        '''取出一个可用连接，返回(conn, reused)元组'''
+        key = (scheme, host, port)
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = self.timeout
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                conn, last_used = idle.pop()
+                if self._is_healthy(conn, last_used):
+                    self.hits += 1
+                    # 每次取出都重新设置超时，不沿用上一个使用者的设置
+                    conn.sock.settimeout(socket.getdefaulttimeout()
+                                         if timeout is socket._GLOBAL_DEFAULT_TIMEOUT else timeout)
+                    return conn, True
+                self.discards += 1
+                conn.close()
+            self.misses += 1
+
+        conn_cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return conn_cls(host, port, timeout=timeout), False
+
+    def put(self, scheme, host, port, conn):
+        '''归还连接，池满时关闭该连接'''
+        if conn.sock is None:
+            return
+        key = (scheme, host, port)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+            self.discards += 1
+        conn.close()
+
+    def clear(self):
+        '''关闭所有空闲连接'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def stats(self):
+        '''返回连接池统计信息'''
+        with self._lock:
+            idle = sum(len(conns) for conns in self._idle.values())
+            return {'hits': self.hits, 'misses': self.misses,
+                    'discards': self.discards, 'idle': idle}
+
+    def _is_healthy(self, conn, last_used):
+        if conn.sock is None:
+            return False
+        if self.idle_timeout is not None and time.time() - last_used > self.idle_timeout:
+            return False
+        try:
+            # 空闲连接上不应有可读数据，可读说明对端已关闭或数据异常
+            # select不支持大于等于1024的fd，有poll时使用poll
+            if hasattr(select, 'poll'):
+                poller = select.poll()
+                poller.register(conn.sock, select.POLLIN)
+                return not poller.poll(0)
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+
+class PooledResponse(object):
+    '''
+    连接池连接上的HTTP响应，接口与urllib2.urlopen的返回值一致
+    close时消息体已读完则归还连接，否则关闭连接
+    '''
+
+    def __init__(self, pool, key, conn, rsp, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._rsp = rsp
+        self._url = url
+        self.code = rsp.status
+        self.msg = rsp.reason
+
+    def getcode(self):
+        return self._rsp.status
+
+    def info(self):
+        return self._rsp.msg
+
+    def geturl(self):
+        return self._url
+
+    def read(self, amt=None):
+        return self._rsp.read(amt)
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, rsp, self._conn = self._conn, self._rsp, None
+        try:
+            if not rsp.isclosed() and rsp.length is not None and rsp.length <= MAX_DRAIN_LEN:
+                rsp.read()
+        except (httplib.HTTPException, socket.error):
+            pass
+        if rsp.isclosed() and not rsp.will_close:
+            self._pool.put(self._key[0], self._key[1], self._key[2], conn)
+        else:
+            conn.close()
+
+
+class StreamResponse(object):
+    '''
+    流式读取的HTTP响应，消息体按块读取，内存占用与消息体大小无关
+    消息体读完或调用close后释放连接
+    '''
+
+    def __init__(self, rsp, chunk_size=STREAM_CHUNK_LEN):
+        self._rsp = rsp
+        self.chunk_size = chunk_size
+        self.status_code = rsp.getcode()
+        self.headers = rsp.info()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self.iter_content()
+
+    def read(self, amt=None):
+        '''读取最多amt字节，amt为None时读取剩余全部消息体，读完返回空字符串'''
+        if self.closed:
+            return ''
+        data = self._rsp.read() if amt is None else self._rsp.read(amt)
+        if not data or amt is None:
+            self.close()
+        return data
+
+    def iter_content(self, chunk_size=None):
+        '''按块迭代消息体，每块最多chunk_size字节'''
+        chunk_size = chunk_size or self.chunk_size
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def iter_lines(self, chunk_size=None, keepends=False):
+        '''按行迭代消息体'''
+        pending = ''
+        for chunk in self.iter_content(chunk_size):
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n' if keepends else line.rstrip('\r')
+        if pending:
+            yield pending
+
+    def read_into(self, buffer):
+        '''
+        读取消息体填充到调用方提供的bytearray/memoryview中，返回读取的字节数，读完返回0
+        底层响应支持readinto时直接读入buffer，否则读出后拷贝一次
+        '''
+        if self.closed:
+            return 0
+        view = memoryview(buffer)
+        size = len(view)
+        readinto = getattr(self._rsp, 'readinto', None)
+        if readinto is not None:
+            n = readinto(view)
+        else:
+            data = self._rsp.read(size)
+            n = len(data)
+            view[:n] = data
+        if not n:
+            self.close()
+        return n
+
+    def close(self):
+        '''释放连接，消息体未读完时连接不会被复用'''
+        if not self.closed:
+            self.closed = True
+            self._rsp.close()
+
+
+class _JsonStreamReader(object):
+    '''从分块到达的json文本中逐个解析值，只缓存尚未解析完的部分'''
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        '''读入下一块数据，已到结尾时返回False'''
+        if self._eof:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        '''跳过空白，返回下一个非空白字符，结尾时返回空字符串'''
+        while True:
+            m = JSON_WHITESPACE.match(self._buf, self._pos)
+            self._pos = m.end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('Expecting one of {!r} at position {}, got {!r}'.format(chars, self._pos, c))
+        self._pos += 1
+        return c
+
+    def value(self):
+        '''解析一个完整的json值'''
+        self.peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if self._fill():
+                    continue
+                raise
+            # 数字可能被块边界截断(如"12"|"3.5")，需确认其后还有非数字字符
+            if type(obj) in (int, long, float) and \
+                    JSON_NUMBER_TAIL.match(self._buf, end).end() == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return obj
+
+
+def iter_json_items(chunks, json_path=None):
+    '''
+    流式解析json数组，逐个返回数组元素
+    chunks - json文本块迭代器
+    json_path - 数组所在路径，以.分隔的键名或数组下标，如data.items，默认为顶层数组
+    '''
+    reader = _JsonStreamReader(chunks)
+    keys = [k for k in (json_path or '').split('.') if k]
+    for key in keys:
+        if reader.peek() == '[' and key.isdigit():
+            reader.expect('[')
+            for _ in range(int(key)):
+                reader.value()
+                reader.expect(',')
+            continue
+        reader.expect('{')
+        while True:
+            if reader.peek() == '}':
+                raise KeyError('json path {!r} not found'.format(json_path))
+            name = reader.value()
+            reader.expect(':')
+            if name == key:
+                break
+            reader.value()
+            reader.expect(',}')
+
+    reader.expect('[')
+    if reader.peek() == ']':
+        return
+    while True:
+        yield reader.value()
+        if reader.expect(',]') == ']':
+            return
+
+
+class _HostScheduler(object):
+    '''
+    request_many的任务调度器，保证同一host:port同时进行的请求数不超过per_host
+    '''
+
+    def __init__(self, specs, per_host=None):
+        self._pending = [(idx, urlparse.urlsplit(spec[1]).netloc, tuple(spec))
+                         for idx, spec in enumerate(specs)]
+        self._pending.reverse()
+        self._per_host = per_host
+        self._inflight = {}
+        self._cond = threading.Condition()
+
+    def take(self):
+        '''取出一个所属host未达上限的任务，全部任务已分配时返回None'''
+        with self._cond:
+            while self._pending:
+                for i in range(len(self._pending) - 1, -1, -1):
+                    host = self._pending[i][1]
+                    if not self._per_host or self._inflight.get(host, 0) < self._per_host:
+                        self._inflight[host] = self._inflight.get(host, 0) + 1
+                        return self._pending.pop(i)
+                self._cond.wait()
+        return None
+
+    def release(self, host):
+        with self._cond:
+            self._inflight[host] -= 1
+            self._cond.notify_all()
 
 
 class HttpClient(object):
@@ -16,6 +388,19 @@ class HttpClient(object):
     HTTP客户端
     '''
 
+    def __init__(self, keep_alive=True, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 pool_idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT, timeout=None):
+        '''
+        keep_alive - 是否复用HTTP/1.1长连接，为False时每次请求新建连接
+        pool_maxsize - 每个host:port最多缓存的空闲连接数
+        pool_idle_timeout - 空闲连接超时时间(秒)
+        timeout - 请求超时时间(秒)，默认使用socket全局超时
+        '''
+        self.pool = ConnectionPool(pool_maxsize, pool_idle_timeout,
+                                   socket._GLOBAL_DEFAULT_TIMEOUT if timeout is None else timeout) \
+            if keep_alive else None
+        self.timeout = timeout
+
     def get_url(self, host, port, uri, **query_args):
         '''
         拼接完整的url
@@ -96,15 +481,19 @@ class HttpClient(object):
         '''
         return self._request('POST', url, headers, body, xauth)
 
-    def json_request(self, url, method='POST', json_data=None, headers=None, xauth=None):
+    def json_request(self, url, method='POST', json_data=None, headers=None, xauth=None,
+                     stream=False, json_path=None):
         '''
         发起json格式的请求，消息体格式化为json格式， 返回(status_code, rsp_body)元组
+        stream为True时边下载边解析，rsp_body为逐个返回数组元素的迭代器，内存占用与响应大小无关
 
         Parameters:
             - url - 请求的url
             - json_data - 请求消息体，json格式
             - headers - HTTP请求头
             - xauth - 消息加密认证信息，格式为(usr, pwd)，如('user', 'pwd')
+            - stream - 是否流式解析响应，响应顶层(或json_path指向的)必须为数组
+            - json_path - 流式解析时数组所在路径，以.分隔的键名或数组下标，如data.items
         Example:
             | json_request | url | method | json_data | headers | xauth |
             | json_request | http://192.168.199.149:6610/nginx-status | POST | {"key":"value"} | | |
@@ -114,11 +503,97 @@ class HttpClient(object):
         headers['Content-Type'] = headers.get('Content-Type', 'application/json; charset=UTF-8')
 
         body = json.dumps(json_data) if type(json_data) in (dict, list) else (json_data or '')
+        if stream:
+            status_code, rsp = self.stream(method, url, headers, body, xauth)
+            if rsp is None:
+                return status_code, iter(())
+            return status_code, iter_json_items(rsp.iter_content(), json_path)
         status_code, rsp_body = self._request(method, url, headers, body, xauth)
         return status_code, json.loads(rsp_body or '')
 
-    def _request(self, method, url, headers=None, body=None, xauth=None):
-        '''发起HTTP请求'''
+    def request_many(self, specs, concurrency=10, timeout=None, per_host=None):
+        '''
+        并发发起多个请求，按输入顺序返回(status_code, rsp_body)元组列表
+
+        Parameters:
+            - specs - 请求列表，每项为(method, url, headers, body, xauth)元组，末尾可省略
+            - concurrency - 并发线程数
+            - timeout - 单个请求的超时时间(秒)
+            - per_host - 同一host:port同时进行的最大请求数，默认不限制
+        Example:
+            | ${specs} | Create List | ${spec1} | ${spec2} |
+            | request_many | ${specs} | 10 | 5 | 2 |
+        '''
+        specs = list(specs)
+        results = [None] * len(specs)
+        for idx, result in self.iter_request_many(specs, concurrency, timeout, per_host):
+            results[idx] = result
+        return results
+
+    def iter_request_many(self, specs, concurrency=10, timeout=None, per_host=None):
+        '''
+        并发发起多个请求，按完成顺序逐个返回(index, (status_code, rsp_body))，index为请求在specs中的序号
+        参数同request_many
+        '''
+        specs = list(specs)
+        if not specs:
+            return
+        scheduler = _HostScheduler(specs, per_host)
+        done = Queue.Queue()
+
+        def worker():
+            while True:
+                task = scheduler.take()
+                if task is None:
+                    return
+                idx, host, spec = task
+                # 与_request出错时的返回值一致，保证每个请求都有结果，调用方不会一直等待
+                result = (-1, None)
+                try:
+                    result = self._request(*spec, timeout=timeout)
+                except Exception, e:
+                    logger.error('Request {} exception: {}'.format(idx, e), logtrace=True)
+                finally:
+                    scheduler.release(host)
+                    done.put((idx, result))
+
+        for _ in range(min(max(int(concurrency), 1), len(specs))):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+
+        for _ in range(len(specs)):
+            yield done.get()
+
+    def stream(self, method, url, headers=None, body=None, xauth=None, timeout=None):
+        '''
+        发起HTTP请求并以流的方式读取消息体，返回(status_code, StreamResponse)元组，失败时为(-1, None)
+        消息体不截断，通过StreamResponse的iter_content/iter_lines/read_into分块读取，读完后连接自动归还连接池
+
+        Parameters:
+            - method - 请求方法
+            - url - 请求的url
+            - headers - HTTP请求头
+            - body - 请求消息体
+            - xauth - 消息加密认证信息，格式为(usr, pwd)，如('user', 'pwd')
+            - timeout - 请求超时时间(秒)
+        Example:
+            | ${code} | ${rsp} | stream | GET | http://192.168.199.149:6610/big.json |
+        '''
+        req = self._build_request(method, url, headers, body, xauth)
+        try:
+            rsp = self.urlopen(req, body, timeout)
+            logger.debug('Response:\n%s', rsp.info())
+            return rsp.getcode(), StreamResponse(rsp)
+        except urllib2.HTTPError, e:
+            logger.error(
+                'HTTP request error:\n{} {}\r\n{}'.format(e.code, e.msg, e.hdrs), logtrace=False)
+        except Exception, e:
+            logger.error('Exception: {}'.format(e), logtrace=True)
+        return -1, None
+
+    def _build_request(self, method, url, headers=None, body=None, xauth=None):
+        '''构造urllib2.Request并记录请求日志'''
         req = urllib2.Request(url)
         req.get_method = lambda: method
 
@@ -130,18 +605,26 @@ class HttpClient(object):
             uri = self._get_uri(url)
             req.add_header('X-Auth', self._get_xauth(xauth, uri, body))
 
-        logger.debug('Request:\n{}'.format(self._req2str(req, body)))
+        logger.debug(lambda: 'Request:\n' + self._req2str(req, body))
+        return req
+
+    def _request(self, method, url, headers=None, body=None, xauth=None, timeout=None):
+        '''发起HTTP请求'''
+        req = self._build_request(method, url, headers, body, xauth)
 
         status_code, hdrs, rsp_body = -1, {}, None
         try:
-            rsp = urllib2.urlopen(req, body)
-            status_code, hdrs = rsp.getcode(), rsp.info()
-            ctype = hdrs.get('Content-Type', '')
-            if ctype.startswith('text') or 'application/json' in ctype:
-                rsp_body = rsp.read(MAX_READ_LEN)
-            else:
-                logger.info('Http client not read http body yet.')
-            logger.debug('Response:\n{}\r\n\r\n{}'.format(rsp.info(), rsp_body))
+            rsp = self.urlopen(req, body, timeout)
+            try:
+                status_code, hdrs = rsp.getcode(), rsp.info()
+                ctype = hdrs.get('Content-Type', '')
+                if ctype.startswith('text') or 'application/json' in ctype:
+                    rsp_body = rsp.read(MAX_READ_LEN)
+                else:
+                    logger.info('Http client not read http body yet.')
+                logger.debug('Response:\n%s\r\n\r\n%s', hdrs, rsp_body)
+            finally:
+                rsp.close()
         except urllib2.HTTPError, e:
             logger.error(
                 'HTTP request error:\n{} {}\r\n{}'.format(e.code, e.msg, e.hdrs), logtrace=False)
@@ -150,6 +633,79 @@ class HttpClient(object):
 
         return status_code, rsp_body
 
+    def get_pool_stats(self):
+        '''
+        返回连接池统计信息字典: hits(复用次数), misses(新建次数), discards(丢弃次数), idle(空闲连接数)
+
+        Example:
+            | ${stats} | get_pool_stats |
+        '''
+        if not self.pool:
+            return {'hits': 0, 'misses': 0, 'discards': 0, 'idle': 0}
+        return self.pool.stats()
+
+    def urlopen(self, req, body=None, timeout=None):
+        '''
+        发送urllib2.Request请求，接口与urllib2.urlopen一致，keep_alive时使用连接池中的长连接
+        需要经过代理或安装了定制opener时(见_need_urllib2)仍使用urllib2.urlopen
+        返回响应对象，状态码>=400时抛出urllib2.HTTPError
+        '''
+        timeout = timeout if timeout is not None else self.timeout
+        timeout = socket._GLOBAL_DEFAULT_TIMEOUT if timeout is None else timeout
+        if not self.pool or _need_urllib2(req.get_full_url()):
+            return urllib2.urlopen(req, body, timeout)
+
+        method, url = req.get_method(), req.get_full_url()
+        headers = dict(req.header_items())
+        headers.setdefault('User-agent', USER_AGENT)
+        for _ in range(MAX_REDIRECTIONS + 1):
+            if body is not None:
+                headers.setdefault('Content-type', 'application/x-www-form-urlencoded')
+            rsp = self._pooled_request(method, url, headers, body, timeout)
+            code, location = rsp.getcode(), rsp.info().get('Location')
+            if code in (301, 302, 303, 307) and location and \
+                    (method in ('GET', 'HEAD') or (code != 307 and method == 'POST')):
+                # 与urllib2一致：跟随重定向，POST转为不带消息体的GET
+                rsp.close()
+                url = urlparse.urljoin(url, location)
+                if method == 'POST':
+                    method, body = 'GET', None
+                    headers = dict((k, v) for k, v in headers.items()
+                                   if k.lower() not in ('content-type', 'content-length'))
+                if _need_urllib2(url):
+                    req = urllib2.Request(url, body, headers)
+                    req.get_method = lambda: method
+                    return urllib2.urlopen(req, timeout=timeout)
+                continue
+            if code >= 400:
+                hdrs, msg = rsp.info(), rsp.msg
+                rsp.close()
+                raise urllib2.HTTPError(url, code, msg, hdrs, None)
+            return rsp
+        raise urllib2.HTTPError(url, code, 'Too many redirections', rsp.info(), None)
+
+    def _pooled_request(self, method, url, headers, body, timeout):
+        '''在连接池连接上发送请求，复用的连接已被对端关闭时新建连接重试一次'''
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        host = parts.hostname
+        port = parts.port or (443 if scheme == 'https' else 80)
+        selector = parts.path or '/'
+        if parts.query:
+            selector = '{}?{}'.format(selector, parts.query)
+
+        while True:
+            conn, reused = self.pool.get(scheme, host, port, timeout)
+            try:
+                conn.request(method, selector, body, headers)
+                rsp = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            return PooledResponse(self.pool, (scheme, host, port), conn, rsp, url)
+
     def _req2str(self, req, body):
         hdrs = '\r\n'.join('{}: {}'.format(k, v) for k, v in req.headers.items())
         return '{} {}\r\n{}\r\n\r\n{}'.format(req.get_method(),
@@ -10,12 +10,45 @@ import sys
 import os.path
 import logging
 
+CALL_SITE_CACHE_SIZE = 10000  # 调用点缓存的最大条目数，超过后清空重建
+
+
+def _source_file(filename):
+    """
+    Normalize a module or code file name to its source file path, so that
+    'x.pyc', 'x.pyo' and '__pycache__/x.cpython-XY.pyc' all map to 'x.py'.
+    """
+    filename = os.path.normcase(os.path.abspath(filename))
+    base, ext = os.path.splitext(filename)
+    if ext in ('.pyc', '.pyo'):
+        dirname, name = os.path.split(base)
+        if os.path.basename(dirname) == '__pycache__':
+            dirname = os.path.dirname(dirname)
+            name = name.split('.', 1)[0]
+        filename = os.path.join(dirname, name + '.py')
+    return filename
+
+
+_logging_file = _source_file(logging.__file__)
+_internal_codes = {}  # code object -> 是否为logging模块内部的帧
+_call_sites = {}      # (code object, f_lasti) -> (filename, lineno, funcname)
+
+
+def _is_internal(co):
+    internal = _internal_codes.get(co)
+    if internal is None:
+        internal = _internal_codes[co] = _source_file(co.co_filename) == _logging_file
+    return internal
+
 
 class LoggerWarpper(logging.Logger):
 
+    # 开启后同一调用点(代码对象+字节码偏移)只解析一次调用信息
+    cache_call_site = False
+
     def __init__(self, name, level=logging.NOTSET):
         logging.Logger.__init__(self, name, level)
-        self._logger_file = logging.__file__.replace('.pyc', '.py')
+        self._logger_file = _logging_file
 
     def findCaller(self, skip_frame=0):
         """
@@ -25,16 +58,23 @@ class LoggerWarpper(logging.Logger):
         # skip findCaller and _log function
         f = sys._getframe(2)
         rv = "(unknown file)", 0, "(unknown function)"
-        while f and hasattr(f, "f_code"):
+        while f is not None:
             co = f.f_code
-            if co.co_filename == self._logger_file:
+            if _is_internal(co):
                 f = f.f_back
                 continue
             if skip_frame > 0:
                 skip_frame -= 1
                 f = f.f_back
                 continue
-            rv = (co.co_filename, f.f_lineno, co.co_name)
+            if not self.cache_call_site:
+                return co.co_filename, f.f_lineno, co.co_name
+            key = (co, f.f_lasti)
+            rv = _call_sites.get(key)
+            if rv is None:
+                if len(_call_sites) >= CALL_SITE_CACHE_SIZE:
+                    _call_sites.clear()
+                rv = _call_sites[key] = (co.co_filename, f.f_lineno, co.co_name)
             break
         return rv
 
@@ -72,6 +112,7 @@ if __name__ == '__main__':
     screen_handler = logging.StreamHandler()
     screen_handler.setFormatter(formatter)
     logger.addHandler(screen_handler)
+    logger.cache_call_site = True
 
     log_func_line('log_func_line')
     log_real_line('log_real_line')
@@ -4,11 +4,17 @@
 # Date: 2016-04-29
 
 import sys
-from pyh import *
 import time
+import os
+import glob
+import json
+import hashlib
+import multiprocessing
 
 
 CHARSET = 'GB2312'
+TITLE = 'SystemTest Test Report'
+DOCTYPE = '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">\n'
 META = '''<meta http-equiv="Content-Type" content="text/html; charset=%s" /> ''' % CHARSET
 CSS = '''<style type="text/css">
 body {font-family: Helvetica, sans-serif; font-size: 0.8em; color: black; padding: 6px; background: white;}
@@ -40,48 +46,141 @@ h2 {clear: left;}
 .pass-bar, .fail-bar {float: left;height: 100%;}
 .pass-bar {background: #1d4;}
 </style>'''
+REPORT_NAME = 'report.html'                 # 批量模式下扫描目录时查找的报告文件名
+MANIFEST_NAME = '.rfreport_manifest.json'   # 批量模式下记录已转换报告信息的清单文件名
+HASH_READ_LEN = 1 << 20
+STATS_WHITESPACE = ' \t\r\n'
+
+_utf8_keys = {}
+
+
+def _utf8_object(pairs):
+    # json解析出的字符串为unicode，转为utf8编码的str，与原先eval的结果保持一致
+    item = {}
+    for k, v in pairs:
+        if v.__class__ is unicode:
+            v = v.encode('utf8')
+        key = _utf8_keys.get(k)
+        if key is None:
+            key = _utf8_keys[k] = k.encode('utf8')
+        item[key] = v
+    return item
+
+
+_json_decoder = json.JSONDecoder(object_pairs_hook=_utf8_object)
 
 
 def time2str(millisec):
     return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(millisec/1000))
 
 
+# 以下直接拼接HTML字符串，输出与原先使用的pyh完全一致：
+# 属性按关键字参数字典的顺序输出(cl输出为class)，每个标签闭合后跟一个换行
+def render_attrs(attrs):
+    return ''.join(' %s="%s"' % ('class' if n == 'cl' else n, v) for n, v in attrs.iteritems())
+
+
+def open_tag(name, **attrs):
+    return '<%s%s>' % (name, render_attrs(attrs))
+
+
+def tag(name, content='', **attrs):
+    return '<%s%s>%s</%s>\n' % (name, render_attrs(attrs), content, name)
+
+
 def generate_bar(passed, failed):
     total = passed + failed
     pass_perent = 100.0 * passed / total
     fail_perent = 100.0 * failed / total
-    mydiv = div(cl='graph')
-    mydiv << div(cl='pass-bar', style='width: %d%%' % pass_perent, title='%.1f%%' % pass_perent)
-    mydiv << div(cl='fail-bar', style='width: %d%%' % fail_perent, title='%.1f%%' % fail_perent)
-    return mydiv.render()
+    return tag('div',
+                tag('div', cl='pass-bar', style='width: %d%%' % pass_perent, title='%.1f%%' % pass_perent) +
+                tag('div', cl='fail-bar', style='width: %d%%' % fail_perent, title='%.1f%%' % fail_perent),
+                cl='graph')
 
 
 def generate_stat_table_header(table_name):
-    table_header = tr()
-    table_header << th(table_name)
-    table_header << th('Total', cl='stats-col-stat')
-    table_header << th('Pass', cl='stats-col-stat')
-    table_header << th('Fail', cl='stats-col-stat')
-    table_header << th('Elapsed', cl='stats-col-elapsed')
-    table_header << th('Pass/Fail', cl='stats-col-graph')
-    return table_header.render()
+    return tag('tr', ''.join([
+        tag('th', table_name),
+        tag('th', 'Total', cl='stats-col-stat'),
+        tag('th', 'Pass', cl='stats-col-stat'),
+        tag('th', 'Fail', cl='stats-col-stat'),
+        tag('th', 'Elapsed', cl='stats-col-elapsed'),
+        tag('th', 'Pass/Fail', cl='stats-col-graph')]))
 
 
 def generate_stat_table_line(stat_suite):
     # {"elapsed":"02:26:23","fail":17,"label":"Critical Tests","pass":149}
     failed, passed = stat_suite['fail'], stat_suite['pass']
-    table_line = tr()
-    table_line << td(stat_suite['label'].decode('utf8').encode(CHARSET), cl='stats-col-name')
-    table_line << td(passed+failed, cl='stats-col-stat')
-    table_line << td(passed, cl='stats-col-stat')
     cls = ' bg_fail' if failed > 0 else ''
-    table_line << td(failed, cl='stats-col-stat' + cls)
-    table_line << td(stat_suite['elapsed'], cl='stats-col-elapsed')
-    table_line << td(generate_bar(passed, failed), cl='stats-col-graph')
-    return table_line.render()
+    return tag('tr', ''.join([
+        tag('td', stat_suite['label'].decode('utf8').encode(CHARSET), cl='stats-col-name'),
+        tag('td', passed+failed, cl='stats-col-stat'),
+        tag('td', passed, cl='stats-col-stat'),
+        tag('td', failed, cl='stats-col-stat' + cls),
+        tag('td', stat_suite['elapsed'], cl='stats-col-elapsed'),
+        tag('td', generate_bar(passed, failed), cl='stats-col-graph')]))
+
 
+def write_stat_table(f, table_id, table_name, items):
+    # 逐行生成并写入统计表，不在内存中保留整张表
+    f.write(open_tag('table', cl='statistics', id=table_id))
+    f.write(generate_stat_table_header(table_name))
+    for item in items:
+        f.write(generate_stat_table_line(item))
+    f.write('</table>\n')
 
-def get_result_stats(orig_report):
+
+def _skip_whitespace(text, pos):
+    while pos < len(text) and text[pos] in STATS_WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _parse_stats_array(text, pos, limit=None):
+    '''
+    从text[pos]处的'['开始逐个元素解析数组，返回(元素列表, 数组之后的位置)，
+    元素个数达到limit时停止解析，返回的位置为None
+    '''
+    items = []
+    pos = _skip_whitespace(text, pos + 1)
+    if text[pos:pos+1] == ']':
+        return items, pos + 1
+    while True:
+        if limit is not None and len(items) >= limit:
+            return items, None
+        item, pos = _json_decoder.raw_decode(text, pos)
+        items.append(item.encode('utf8') if item.__class__ is unicode else item)
+        pos = _skip_whitespace(text, pos)
+        if text[pos:pos+1] == ']':
+            return items, pos + 1
+        if text[pos:pos+1] != ',':
+            raise ValueError('Expecting , or ] at position %d' % pos)
+        pos = _skip_whitespace(text, pos + 1)
+
+
+def parse_stats(stats_str, max_suites=None):
+    '''
+    解析window.output["stats"]的字面量: [[总体统计], [按tag统计], [按suite统计]]
+    用json逐个元素解析代替eval，max_suites限制最多解析的suite个数，超出部分直接忽略
+    '''
+    stats = []
+    pos = _skip_whitespace(stats_str, 0)
+    if stats_str[pos:pos+1] != '[':
+        raise ValueError('Expecting [ at position %d' % pos)
+    pos = _skip_whitespace(stats_str, pos + 1)
+    while stats_str[pos:pos+1] == '[':
+        limit = max_suites if len(stats) == 2 else None
+        items, pos = _parse_stats_array(stats_str, pos, limit)
+        stats.append(items)
+        if pos is None:
+            break
+        pos = _skip_whitespace(stats_str, pos)
+        if stats_str[pos:pos+1] == ',':
+            pos = _skip_whitespace(stats_str, pos + 1)
+    return stats
+
+
+def get_result_stats(orig_report, max_suites=None):
     starttime, elapsed, stats = 0, 0, []
     starttime_keyword = 'window.output["baseMillis"] = '
     elapsed_keyword = 'window.output["generatedMillis"] = '
@@ -93,8 +192,11 @@ def get_result_stats(orig_report):
             elif line.startswith(elapsed_keyword):
                 elapsed = int(line[len(elapsed_keyword):-2].strip('"'))
             elif line.startswith(stats_keyword):
-                stats_str = line[len(stats_keyword):-2]
-                stats = eval(stats_str)
+                stats_str = line[len(stats_keyword):].rstrip().rstrip(';')
+                try:
+                    stats = parse_stats(stats_str, max_suites)
+                except ValueError, e:
+                    print '###### Parse result stats from report file<%s> error: %s' % (orig_report, e)
             if starttime and elapsed and stats:
                 break
     return starttime, starttime+elapsed, stats
@@ -109,11 +211,11 @@ def get_all_stats(totoal_stats):
     return elapsed, fail_num, pass_num
 
 
-def convert(orig_report, new_report):
-    starttime, endtime, result_stats = get_result_stats(orig_report)
+def convert(orig_report, new_report, max_suites=None):
+    starttime, endtime, result_stats = get_result_stats(orig_report, max_suites)
     if not result_stats or len(result_stats) < 3:
         print '###### Get result stats from report file<%s> failed!' % (orig_report)
-        return
+        return False
 
     totoal_stats = result_stats[0]
     tag_stats = result_stats[1]
@@ -121,10 +223,6 @@ def convert(orig_report, new_report):
 
     elapsed, fail_num, pass_num = get_all_stats(totoal_stats)
 
-    page = PyH('SystemTest Test Report')
-    page.head.append(META)
-    page.head.append(CSS)
-
     if fail_num > 0:
         status = '%d critical tests failed' % fail_num
         cls = 'fail'
@@ -132,42 +230,214 @@ def convert(orig_report, new_report):
         status = 'All tests passed'
         cls = 'pass'
 
-    html_body = page << body(cl='bg_' + cls)
+    # 先写到临时文件，完整生成后再替换，中途出错时保留原有的报告
+    tmp_report = new_report + '.tmp'
+    try:
+        with open(tmp_report, 'w') as f:
+            f.write(DOCTYPE)
+            f.write('<html%s>' % render_attrs(dict(xmlns='http://www.w3.org/1999/xhtml', lang='en')))
+            f.write('<head>' + tag('title', TITLE) + META + CSS + '</head>\n')
+            f.write(tag('body'))
+            f.write(open_tag('body', cl='bg_' + cls))
 
-    # Summary Information
-    html_body << h2('Summary Information')
-    details_table = html_body << table(cl='details')
-    details_table << tr() << th('Status:') + td(status, cl=cls)
-    details_table << tr() << th('Start Time:') + td(time2str(starttime))
-    details_table << tr() << th('End Time:') + td(time2str(endtime))
-    details_table << tr() << th('Elapsed Time:') + td(elapsed)
+            # Summary Information
+            f.write(tag('h2', 'Summary Information'))
+            f.write(tag('table', ''.join([
+                tag('tr', tag('th', 'Status:') + tag('td', status, cl=cls)),
+                tag('tr', tag('th', 'Start Time:') + tag('td', time2str(starttime))),
+                tag('tr', tag('th', 'End Time:') + tag('td', time2str(endtime))),
+                tag('tr', tag('th', 'Elapsed Time:') + tag('td', elapsed))]), cl='details'))
 
-    stats_div = html_body << div(id="statistics-container")
+            f.write(open_tag('div', id="statistics-container"))
 
-    # Test Statistics
-    stats_div << h2('Test Statistics')
-    total_stat_table = stats_div << table(cl='statistics', id="total-stats")
-    total_stat_table << generate_stat_table_header('Total Statistics')
-    for item in totoal_stats:
-        total_stat_table << generate_stat_table_line(item)
+            # Test Statistics
+            f.write(tag('h2', 'Test Statistics'))
+            write_stat_table(f, "total-stats", 'Total Statistics', totoal_stats)
+
+            # Statistics by Tag
+            write_stat_table(f, "tag-stats", 'Statistics by Tag', tag_stats)
+
+            # Statistics by Suite
+            write_stat_table(f, "suite-stats", 'Statistics by Suite', suite_stats)
+
+            f.write('</div>\n')
+            f.write('</body>\n')
+            f.write('</html>\n')
+        os.rename(tmp_report, new_report)
+    except Exception:
+        if os.path.exists(tmp_report):
+            os.remove(tmp_report)
+        raise
+    return True
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_READ_LEN), ''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _common_dir(paths):
+    # 按路径分段求公共前缀，避免commonprefix按字符比较得到'ci/run'这样的半截目录
+    parts = os.path.commonprefix([path.split(os.sep) for path in paths])
+    return os.sep.join(parts) or os.sep
+
+
+def find_reports(sources, out_dir):
+    '''
+    sources中的每一项可以是目录(递归查找REPORT_NAME)、通配符或报告文件，
+    返回[(orig_report, new_report)]，新报告在out_dir下保持相对于所有目录/通配符前缀的公共目录的路径，
+    多个报告对应同一个新报告路径时抛出ValueError
+    '''
+    found, roots, seen = [], [], set()
+    for source in sources:
+        if os.path.isdir(source):
+            root = source
+            paths = [os.path.join(dirpath, REPORT_NAME)
+                     for dirpath, _, filenames in os.walk(source) if REPORT_NAME in filenames]
+        else:
+            # 通配符之前的目录部分作为相对路径的起点
+            root = os.path.dirname(source.split('*', 1)[0].split('?', 1)[0].split('[', 1)[0])
+            paths = glob.glob(source)
+        roots.append(os.path.abspath(root or '.'))
+        for path in sorted(paths):
+            orig = os.path.abspath(path)
+            if orig not in seen:
+                seen.add(orig)
+                found.append(orig)
+
+    tasks, targets = [], {}
+    common = _common_dir(roots) if roots else ''
+    for orig in found:
+        new = os.path.join(out_dir, os.path.relpath(orig, common))
+        if new in targets:
+            raise ValueError('Reports <%s> and <%s> would both be written to <%s>' % (targets[new], orig, new))
+        targets[new] = orig
+        tasks.append((orig, new))
+    return tasks
+
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_manifest(manifest_path, manifest):
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, manifest_path)
+
+
+def _report_state(orig_report, use_hash):
+    st = os.stat(orig_report)
+    state = {'mtime': st.st_mtime, 'size': st.st_size}
+    if use_hash:
+        state['md5'] = file_md5(orig_report)
+    return state
+
+
+def _is_unchanged(entry, state, new_report, use_hash):
+    if not entry or entry.get('new') != new_report or not os.path.exists(new_report):
+        return False
+    if use_hash:
+        return entry.get('md5') == state['md5']
+    return entry.get('mtime') == state['mtime'] and entry.get('size') == state['size']
+
+
+def _convert_task(task):
+    # 进程池中执行的转换任务，返回(orig_report, new_report, 是否成功, 耗时, 错误信息)
+    orig_report, new_report = task
+    start = time.time()
+    try:
+        dirpath = os.path.dirname(new_report)
+        if dirpath and not os.path.exists(dirpath):
+            try:
+                os.makedirs(dirpath)
+            except OSError:
+                if not os.path.isdir(dirpath):
+                    raise
+        ok, error = bool(convert(orig_report, new_report)), ''
+    except Exception, e:
+        ok, error = False, str(e)
+    return orig_report, new_report, ok, time.time() - start, error
+
+
+def convert_batch(sources, out_dir, workers=None, use_hash=False, manifest_path=None):
+    '''
+    批量转换报告：用进程池并行转换，workers为进程数(默认CPU数)，
+    清单文件中记录每个报告的mtime/size(use_hash时为md5)，未变化且新报告存在的跳过
+    返回[(orig_report, new_report, status, elapsed, error)]，status为converted/skipped/failed
+    '''
+    manifest_path = manifest_path or os.path.join(out_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    results, pending, states = [], [], {}
+    for orig_report, new_report in find_reports(sources, out_dir):
+        state = _report_state(orig_report, use_hash)
+        if _is_unchanged(manifest.get(orig_report), state, new_report, use_hash):
+            results.append((orig_report, new_report, 'skipped', 0.0, ''))
+        else:
+            states[orig_report] = state
+            pending.append((orig_report, new_report))
+
+    workers = min(workers or multiprocessing.cpu_count(), len(pending))
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            converted = pool.map(_convert_task, pending, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        converted = map(_convert_task, pending)
+
+    for orig_report, new_report, ok, elapsed, error in converted:
+        if ok:
+            manifest[orig_report] = dict(states[orig_report], new=new_report)
+        else:
+            manifest.pop(orig_report, None)
+        results.append((orig_report, new_report, 'converted' if ok else 'failed', elapsed, error))
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    save_manifest(manifest_path, manifest)
+    return results
 
-    # Statistics by Tag
-    stat_by_tag_table = stats_div << table(cl='statistics', id="tag-stats")
-    stat_by_tag_table << generate_stat_table_header('Statistics by Tag')
-    for item in tag_stats:
-        stat_by_tag_table << generate_stat_table_line(item)
 
-    # Statistics by Suite
-    stat_by_suite_table = stats_div << table(cl='statistics', id="suite-stats")
-    stat_by_suite_table << generate_stat_table_header('Statistics by Suite')
-    for item in suite_stats:
-        stat_by_suite_table << generate_stat_table_line(item)
+def print_summary(results, elapsed):
+    counts = dict((status, 0) for status in ('converted', 'skipped', 'failed'))
+    for orig_report, new_report, status, cost, error in sorted(results, key=lambda r: -r[3]):
+        counts[status] += 1
+        print '%-9s %8.3fs  %s -> %s%s' % (status, cost, orig_report, new_report, (' (%s)' % error) if error else '')
+    print 'Total %d reports: %d converted, %d skipped, %d failed, cost time: %.2fs' % (
+        len(results), counts['converted'], counts['skipped'], counts['failed'], elapsed)
 
-    page.printOut(new_report)
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
+    if '--batch' in sys.argv:
+        # RFReportRewriter.py --batch [--workers=N] [--hash] [--manifest=path] new_dir src [src ...]
+        opts = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+        args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+        if len(args) < 2:
+            print 'Usage: %s --batch [--workers=N] [--hash] [--manifest=path] new_dir src [src ...]' % sys.argv[0]
+            print 'Demo : %s --batch --workers=8 new "ci/*/report.html" nightly/' % sys.argv[0]
+            exit(0)
+        start = time.time()
+        try:
+            results = convert_batch(args[1:], args[0], int(opts.get('workers', 0)) or None,
+                                    '--hash' in sys.argv, opts.get('manifest'))
+        except ValueError, e:
+            print '###### %s' % e
+            exit(1)
+        print_summary(results, time.time() - start)
+    elif len(sys.argv) < 3:
         print 'Usage: %s orig_report_path new_report_path' % sys.argv[0]
+        print '       %s --batch [--workers=N] [--hash] [--manifest=path] new_dir src [src ...]' % sys.argv[0]
         print 'Demo : %s orig/report.html new/report.html' % sys.argv[0]
     else:
         orig_report_path = sys.argv[1]
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+#
+# RobotFramework报告历史趋势：
+#   add    解析新的report.html，把统计结果追加到统计库(每行为"开始时间毫秒\t统计JSON")，同一开始时间只记录一次
+#   render 从统计库中读取最近N次运行，生成总体及按tag/suite的通过/失败、耗时趋势页面
+# 每天只需解析新增的报告，生成页面时也只解析最近N行统计记录
+
+import sys
+import os
+import json
+import heapq
+from RFReportRewriter import get_result_stats, get_all_stats, time2str, \
+    tag, open_tag, render_attrs, DOCTYPE, CHARSET, META, CSS
+
+TREND_TITLE = 'SystemTest Test Trend'
+TREND_RUNS = 30     # 趋势页面默认展示的最近运行次数
+TREND_CSS = '''<style type="text/css">
+.trend td.cell {width: 5em;text-align: center;white-space: nowrap;}
+.trend th.run {width: 5em;font-size: 0.85em;}
+.trend td.none {background: #eee;}
+</style>'''
+
+
+def _compact(items):
+    return [dict(label=item.get('label', ''), pass_num=item.get('pass', 0),
+                 fail_num=item.get('fail', 0), elapsed=item.get('elapsed', '')) for item in items]
+
+
+def load_keys(store):
+    '''读取统计库中已有的运行开始时间，只解析每行的前缀'''
+    keys = set()
+    if os.path.exists(store):
+        with open(store) as f:
+            for line in f:
+                key = line.split('\t', 1)[0]
+                if key.isdigit():
+                    keys.add(int(key))
+    return keys
+
+
+def add_report(store, orig_report, keys=None):
+    '''解析报告并追加到统计库，返回是否新增(报告解析失败或已存在时返回False)'''
+    starttime, endtime, result_stats = get_result_stats(orig_report)
+    if not result_stats or len(result_stats) < 3:
+        print '###### Get result stats from report file<%s> failed!' % (orig_report)
+        return False
+    keys = load_keys(store) if keys is None else keys
+    if starttime in keys:
+        return False
+
+    elapsed, fail_num, pass_num = get_all_stats(result_stats[0])
+    run = {
+        'start': starttime,
+        'end': endtime,
+        'report': os.path.abspath(orig_report),
+        'elapsed': elapsed,
+        'pass_num': pass_num,
+        'fail_num': fail_num,
+        'total': _compact(result_stats[0]),
+        'tags': _compact(result_stats[1]),
+        'suites': _compact(result_stats[2])
+    }
+    with open(store, 'a') as f:
+        f.write('%d\t%s\n' % (starttime, json.dumps(run, separators=(',', ':'), sort_keys=True)))
+    keys.add(starttime)
+    return True
+
+
+def load_runs(store, runs=TREND_RUNS):
+    '''
+    读取开始时间最近的runs次运行的统计(按开始时间排序)
+    用堆按每行的开始时间前缀选出最近的runs行，补录的旧报告追加在末尾也不会挤掉最近的运行，只解析选中的行
+    '''
+    def keyed_lines(f):
+        for line in f:
+            key = line.split('\t', 1)[0]
+            if key.isdigit():
+                yield int(key), line
+
+    with open(store) as f:
+        lines = heapq.nlargest(runs, keyed_lines(f), key=lambda item: item[0])
+    return [json.loads(line.split('\t', 1)[1]) for _, line in reversed(lines)]
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode(CHARSET, 'xmlcharrefreplace')
+    return value
+
+
+def _run_header(runs, name):
+    cells = [tag('th', name)]
+    for run in runs:
+        cells.append(tag('th', time2str(run['start'])[:10], cl='run', title=time2str(run['start'])))
+    return tag('tr', ''.join(cells))
+
+
+def _trend_cell(item):
+    if item is None:
+        return tag('td', '', cl='cell none')
+    cls = 'cell bg_fail' if item['fail_num'] > 0 else 'cell bg_pass'
+    return tag('td', '%d/%d' % (item['pass_num'], item['fail_num']), cl=cls, title=_text(item['elapsed']))
+
+
+def write_trend_table(f, table_id, table_name, runs, field):
+    '''每行为一个tag/suite，每列为一次运行，单元格为 通过数/失败数，悬停显示耗时'''
+    labels, history = [], {}
+    for idx, run in enumerate(runs):
+        for item in run[field]:
+            label = item['label']
+            if label not in history:
+                labels.append(label)
+                history[label] = [None] * len(runs)
+            history[label][idx] = item
+
+    f.write(open_tag('table', cl='statistics trend', id=table_id))
+    f.write(_run_header(runs, table_name))
+    for label in labels:
+        f.write(tag('tr', tag('td', _text(label), cl='stats-col-name') +
+                     ''.join(_trend_cell(item) for item in history[label])))
+    f.write('</table>\n')
+
+
+def render_trend(store, trend_report, runs=TREND_RUNS):
+    runs = load_runs(store, runs)
+    if not runs:
+        print '###### No run stats in store<%s>!' % (store)
+        return False
+
+    with open(trend_report, 'w') as f:
+        f.write(DOCTYPE)
+        f.write('<html%s>' % render_attrs(dict(xmlns='http://www.w3.org/1999/xhtml', lang='en')))
+        f.write('<head>' + tag('title', TREND_TITLE) + META + CSS + TREND_CSS + '</head>\n')
+        f.write(open_tag('body'))
+
+        # Summary Trend
+        f.write(tag('h2', 'Summary Trend'))
+        f.write(open_tag('table', cl='statistics trend', id='summary-trend'))
+        f.write(_run_header(runs, 'Run'))
+        f.write(tag('tr', tag('td', 'Pass/Fail', cl='stats-col-name') + ''.join(
+            _trend_cell(dict(pass_num=run['pass_num'], fail_num=run['fail_num'], elapsed=run['elapsed']))
+            for run in runs)))
+        f.write(tag('tr', tag('td', 'Elapsed', cl='stats-col-name') + ''.join(
+            tag('td', _text(run['elapsed']), cl='cell') for run in runs)))
+        f.write('</table>\n')
+
+        # Trend by Tag / Suite
+        f.write(tag('h2', 'Trend by Tag'))
+        write_trend_table(f, 'tag-trend', 'Tag', runs, 'tags')
+        f.write(tag('h2', 'Trend by Suite'))
+        write_trend_table(f, 'suite-trend', 'Suite', runs, 'suites')
+
+        f.write('</body>\n')
+        f.write('</html>\n')
+    return True
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    opts = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+    if len(args) >= 3 and args[0] == 'add':
+        keys = load_keys(args[1])
+        for orig_report in args[2:]:
+            added = add_report(args[1], orig_report, keys)
+            print '%s report <%s>' % ('Add' if added else 'Skip', orig_report)
+    elif len(args) == 3 and args[0] == 'render':
+        if render_trend(args[1], args[2], int(opts.get('runs', TREND_RUNS))):
+            print 'Generate trend report <%s> success!' % args[2]
+    else:
+        print 'Usage: %s add stats_store report.html [report.html ...]' % sys.argv[0]
+        print '       %s render stats_store trend.html [--runs=N]' % sys.argv[0]
+        print 'Demo : %s add stats.jsonl nightly/report.html' % sys.argv[0]
+        print '       %s render stats.jsonl trend.html --runs=30' % sys.argv[0]
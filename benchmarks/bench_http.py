@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+HttpClient及MultiThreadDownloader的吞吐量基准测试，使用bench_server提供的本地HTTP服务器，结果输出为json
+
+场景:
+    http_get        HttpClient.get的请求速率(长连接/短连接)
+    json_request    HttpClient.json_request的请求速率
+    download        MultiThreadDownloader在不同文件大小、线程数下的吞吐量及每GB消耗的CPU时间，
+                    另外覆盖不支持Range、无Content-Length、限速加延迟、注入错误等服务器
+
+用法: python benchmarks/bench_http.py [--quick] [--requests=N] [--sizes=MB,...] [--threads=N,...] [--output=result.json]
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import platform
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir))
+sys.path.insert(0, BENCH_DIR)
+import logger
+from HttpClient import HttpClient
+from downloader import MultiThreadDownloader
+from bench_server import BenchServer, expected_md5
+
+DEFAULT_REQUESTS = 2000
+DEFAULT_SIZES = [1, 16, 128]        # MB
+DEFAULT_THREADS = [1, 4, 8, 16]
+QUICK_REQUESTS = 300
+QUICK_SIZES = [1, 8]
+QUICK_THREADS = [1, 4]
+SERVER_VARIANTS = [
+    # (名称, 服务器参数, url查询参数)
+    ('norange', {}, '?norange=1'),
+    ('nolength', {}, '?norange=1&nolength=1'),
+    ('throttled', {'latency': 0.02, 'bandwidth': 8 << 20}, ''),
+    ('errors', {'error_rate': 0.05}, ''),
+]
+
+
+class Measure(object):
+    '''记录代码块的墙上时间及本进程消耗的CPU时间'''
+
+    def __enter__(self):
+        self.start, self.cpu_start = time.time(), sum(os.times()[:2])
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.time() - self.start
+        self.cpu = sum(os.times()[:2]) - self.cpu_start
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def bench_requests(base_url, requests):
+    results = []
+    for keep_alive in (True, False):
+        client = HttpClient(keep_alive=keep_alive)
+        url = base_url + '/json?n=10'
+        failed = 0
+        with Measure() as m:
+            for _ in xrange(requests):
+                code, _ = client.get(url)
+                failed += code != 200
+        results.append({
+            'scenario': 'http_get',
+            'params': {'keep_alive': keep_alive, 'requests': requests},
+            'metrics': {'req_per_sec': requests / m.elapsed, 'cpu_ms_per_req': m.cpu * 1000 / requests,
+                        'failed': failed}
+        })
+
+    client = HttpClient()
+    failed = 0
+    with Measure() as m:
+        for i in xrange(requests):
+            code, _ = client.json_request(base_url + '/json', json_data={'seq': i, 'payload': 'x' * 256})
+            failed += code != 200
+    results.append({
+        'scenario': 'json_request',
+        'params': {'keep_alive': True, 'requests': requests},
+        'metrics': {'req_per_sec': requests / m.elapsed, 'cpu_ms_per_req': m.cpu * 1000 / requests,
+                    'failed': failed}
+    })
+    return results
+
+
+def bench_download(url, size, threadnum, workdir, variant='default', **kwargs):
+    dstfile = os.path.join(workdir, 'download.bin')
+    for path in (dstfile, dstfile + '.journal'):
+        if os.path.exists(path):
+            os.remove(path)
+    dl = MultiThreadDownloader(url, dstfile, threadnum, timeout=30, **kwargs)
+    with Measure() as m:
+        ok = dl.download()
+    gb = size / float(1 << 30)
+    return {
+        'scenario': 'download',
+        'params': dict(kwargs, variant=variant, size=size, threadnum=threadnum),
+        'metrics': {
+            'ok': bool(ok),
+            'verified': bool(ok) and file_md5(dstfile) == expected_md5(size),
+            'elapsed': m.elapsed,
+            'mb_per_sec': size / m.elapsed / (1 << 20),
+            'cpu_sec_per_gb': m.cpu / gb
+        }
+    }
+
+
+def run(requests, sizes, threads):
+    results = []
+    workdir = tempfile.mkdtemp(prefix='bench_http_')
+    try:
+        with BenchServer() as server:
+            base_url = 'http://127.0.0.1:%d' % server.port
+            results.extend(bench_requests(base_url, requests))
+            for size_mb in sizes:
+                size = size_mb << 20
+                for threadnum in threads:
+                    results.append(bench_download('%s/file/%d' % (base_url, size), size, threadnum, workdir))
+
+        size, threadnum = max(sizes) << 20, max(threads)
+        for variant, options, query in SERVER_VARIANTS:
+            with BenchServer(**options) as server:
+                url = 'http://127.0.0.1:%d/file/%d%s' % (server.port, size, query)
+                results.append(bench_download(url, size, threadnum, workdir, variant))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def main():
+    opts = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+    quick = '--quick' in sys.argv
+    requests = int(opts.get('requests', QUICK_REQUESTS if quick else DEFAULT_REQUESTS))
+    sizes = [int(s) for s in opts['sizes'].split(',')] if 'sizes' in opts else (QUICK_SIZES if quick else DEFAULT_SIZES)
+    threads = [int(t) for t in opts['threads'].split(',')] if 'threads' in opts else (
+        QUICK_THREADS if quick else DEFAULT_THREADS)
+
+    # 只保留警告及错误日志，避免日志输出影响测试结果
+    logger.set_level('WARN')
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        },
+        'results': run(requests, sizes, threads)
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if 'output' in opts:
+        with open(opts['output'], 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+logger调用开销基准测试，输出每次调用耗时(us)
+
+用法: python benchmarks/bench_logger.py [loops]
+'''
+import os
+import sys
+import time
+import inspect
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import logger
+
+DEFAULT_LOOPS = 20000
+
+
+def _legacy_write(msg, level='INFO', also_file=False, logtrace=False):
+    '''旧实现: 通过inspect.stack()获取调用位置'''
+    exc_str = logger.get_trace_info(logtrace)
+    _, filepath, lineno, _, _, _ = inspect.stack()[2]
+    filename = os.path.basename(filepath)
+    fmt_msg = '{} -- [{}:{}]{}'.format(msg, filename, lineno, exc_str)
+    print '*{}* {}'.format(level, fmt_msg)
+
+
+def _legacy_debug(msg, also_file=False, logtrace=False):
+    _legacy_write(msg, 'DEBUG', also_file, logtrace)
+
+
+def _timeit(func, loops):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        for i in xrange(loops):
+            func('benchmark message')
+        cost = time.time() - start
+        logger.flush()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return cost * 1e6 / loops
+
+
+def main(loops):
+    results = []
+    results.append(('inspect.stack', _timeit(_legacy_debug, loops)))
+    logger.set_capture_caller(True)
+    results.append(('sys._getframe', _timeit(logger.debug, loops)))
+    logger.set_capture_caller(False)
+    results.append(('no caller', _timeit(logger.debug, loops)))
+    logger.set_capture_caller(True)
+    logger.set_level('INFO')
+    results.append(('level disabled', _timeit(logger.debug, loops)))
+    logger.set_level('TRACE')
+    logger.enable_async(block=True)
+    results.append(('async queue', _timeit(logger.debug, loops)))
+    logger.disable_async()
+
+    base = results[0][1]
+    for name, cost in results:
+        print '%-16s %10.2f us/call  x%.1f' % (name, cost, base / cost)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_LOOPS)
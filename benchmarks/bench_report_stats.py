@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+RFReportRewriter解析window.output["stats"]的基准测试：对比原先的eval与parse_stats
+
+用法: python benchmarks/bench_report_stats.py [suites] [loops]
+'''
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import RFReportRewriter
+
+DEFAULT_SUITES = 20000
+DEFAULT_LOOPS = 5
+
+
+def make_stats_str(suites):
+    '''构造与RobotFramework报告格式相同的stats字面量'''
+    def stat(label, i, **kwargs):
+        return dict(kwargs, elapsed='00:%02d:%02d' % (i // 60 % 60, i % 60), fail=i % 3, label=label, pass_=i)
+    total = [stat('Critical Tests', 1), stat('All Tests', 2)]
+    tags = [stat('tag-%d' % i, i) for i in xrange(100)]
+    suite = [stat('Suite %d' % i, i, id='s1-s%d' % i, name='Suite %d' % i) for i in xrange(suites)]
+    return json.dumps([total, tags, suite], separators=(',', ':')).replace('pass_', 'pass')
+
+
+def _timeit(func, loops):
+    start = time.time()
+    for _ in xrange(loops):
+        result = func()
+    return (time.time() - start) * 1000 / loops, result
+
+
+def main(suites, loops):
+    stats_str = make_stats_str(suites)
+    print 'stats literal: %d suites, %.1f MB' % (suites, len(stats_str) / 1048576.0)
+
+    eval_ms, expected = _timeit(lambda: eval(stats_str), loops)
+    parse_ms, stats = _timeit(lambda: RFReportRewriter.parse_stats(stats_str), loops)
+    capped_ms, capped = _timeit(lambda: RFReportRewriter.parse_stats(stats_str, max_suites=100), loops)
+    assert stats == expected, 'parse_stats result differs from eval'
+    assert capped[2] == expected[2][:100]
+
+    print '%-24s %10.1f ms  x%.1f' % ('eval', eval_ms, 1.0)
+    print '%-24s %10.1f ms  x%.1f' % ('parse_stats', parse_ms, eval_ms / parse_ms)
+    print '%-24s %10.1f ms  x%.1f' % ('parse_stats(max=100)', capped_ms, eval_ms / capped_ms)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SUITES,
+         int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_LOOPS)
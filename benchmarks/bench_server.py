@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+基准测试用的本地HTTP服务器，在独立进程中运行，不占用被测进程的CPU
+
+    /file/<size>    返回size字节的确定性数据(可由expected_md5计算摘要)，支持HEAD和单区间Range
+                    ?norange=1 忽略Range头，总是返回完整文件
+                    ?nolength=1 不返回Content-Length，发送完后关闭连接
+    /json?n=<k>     GET返回包含k个元素的json，POST返回请求体长度
+服务器参数:
+    latency     每个请求响应前的延迟(秒)
+    bandwidth   每个连接的带宽上限(字节/秒)，0为不限制
+    error_rate  注入错误的概率，出错时随机返回503或发送一半响应体后断开连接
+
+用法: python benchmarks/bench_server.py [port] [--latency=0.01] [--bandwidth=1048576] [--error-rate=0.01]
+'''
+import sys
+import json
+import time
+import random
+import hashlib
+import urlparse
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+
+PATTERN_LEN = 1 << 20
+WRITE_LEN = 64 * 1024
+PATTERN = ''.join(chr(c) for c in bytearray(random.Random(0).getrandbits(8) for _ in xrange(PATTERN_LEN)))
+
+
+def file_data(start, end):
+    '''返回测试文件[start, end]区间的数据，文件内容为PATTERN的循环'''
+    chunks = []
+    pos = start
+    while pos <= end:
+        offset = pos % PATTERN_LEN
+        n = min(PATTERN_LEN - offset, end - pos + 1)
+        chunks.append(PATTERN[offset:offset + n])
+        pos += n
+    return ''.join(chunks)
+
+
+def expected_md5(size):
+    md5 = hashlib.md5()
+    for start in xrange(0, size, PATTERN_LEN):
+        md5.update(file_data(start, min(start + PATTERN_LEN, size) - 1))
+    return md5.hexdigest()
+
+
+class BenchRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 响应头和响应体分两次发送，不关闭Nagle算法时会与客户端的延迟ACK叠加出40ms延迟
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _inject_error(self):
+        return self.server.error_rate and random.random() < self.server.error_rate
+
+    def _write_body(self, start, end, truncate=False):
+        '''按带宽限制分块发送[start, end]区间的数据，truncate时只发送一半后断开连接'''
+        if truncate:
+            end = start + (end - start + 1) // 2 - 1
+        bandwidth = self.server.bandwidth
+        begin, sent = time.time(), 0
+        for pos in xrange(start, end + 1, WRITE_LEN):
+            data = file_data(pos, min(pos + WRITE_LEN - 1, end))
+            self.wfile.write(data)
+            sent += len(data)
+            if bandwidth:
+                delay = begin + float(sent) / bandwidth - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        if truncate:
+            self.close_connection = 1
+
+    def _send_headers(self, code, headers):
+        self.send_response(code)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+
+    def _send_error(self):
+        body = 'injected error'
+        self._send_headers(503, [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+        self.wfile.write(body)
+
+    def _handle_file(self, size, query):
+        start, end, code = 0, size - 1, 200
+        headers = [('Content-Type', 'application/octet-stream'), ('ETag', '"bench-%d"' % size)]
+        rng = self.headers.get('Range')
+        if rng and rng.startswith('bytes=') and not query.get('norange'):
+            first, last = rng[len('bytes='):].split(',')[0].split('-')
+            start = int(first) if first else max(size - int(last), 0)
+            end = min(int(last), size - 1) if first and last else size - 1
+            code = 206
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, size)))
+        if query.get('nolength'):
+            headers.append(('Connection', 'close'))
+            self.close_connection = 1
+        else:
+            headers.append(('Content-Length', str(end - start + 1)))
+
+        error = self.command == 'GET' and self._inject_error()
+        if error and random.random() < 0.5:
+            return self._send_error()
+        self._send_headers(code, headers)
+        if self.command == 'GET':
+            self._write_body(start, end, truncate=bool(error))
+
+    def _handle_json(self, query, body=None):
+        if self._inject_error():
+            return self._send_error()
+        if body is None:
+            n = int(query.get('n', 10))
+            data = json.dumps({'items': [{'id': i, 'name': 'item-%d' % i} for i in xrange(n)]})
+        else:
+            data = json.dumps({'received': len(body)})
+        self._send_headers(200, [('Content-Type', 'application/json'), ('Content-Length', str(len(data)))])
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _dispatch(self, body=None):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        try:
+            if url.path.startswith('/file/'):
+                return self._handle_file(int(url.path[len('/file/'):]), query)
+            if url.path == '/json':
+                return self._handle_json(query, body)
+        except ValueError:
+            pass
+        self._send_headers(404, [('Content-Type', 'text/plain'), ('Content-Length', '0')])
+
+    def do_HEAD(self):
+        self._dispatch()
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+
+class BenchHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, addr, latency=0.0, bandwidth=0, error_rate=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, addr, BenchRequestHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+
+    def handle_error(self, request, client_address):
+        # 客户端中途断开(如注入错误后重试)属于正常情况，不打印异常
+        pass
+
+
+def _serve(port, options, queue):
+    server = BenchHTTPServer(('127.0.0.1', port), **options)
+    queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class BenchServer(object):
+    '''在子进程中运行BenchHTTPServer，port为0时自动选择端口'''
+
+    def __init__(self, port=0, latency=0.0, bandwidth=0, error_rate=0.0):
+        self.port = port
+        self.options = dict(latency=latency, bandwidth=bandwidth, error_rate=error_rate)
+        self.process = None
+
+    def start(self):
+        queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_serve, args=(self.port, self.options, queue))
+        self.process.daemon = True
+        self.process.start()
+        self.port = queue.get(timeout=10)
+        return 'http://127.0.0.1:%d' % self.port
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == '__main__':
+    opts = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    port = int(args[0]) if args else 8000
+    server = BenchHTTPServer(('127.0.0.1', port), float(opts.get('latency', 0)),
+                             int(opts.get('bandwidth', 0)), float(opts.get('error-rate', 0)))
+    print 'Serving on http://127.0.0.1:%d' % server.server_address[1]
+    server.serve_forever()
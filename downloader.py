@@ -2,11 +2,41 @@
 # -*- coding: utf-8 -*-
 __author__ = 'JiaSong'
 
+import os
+import bisect
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import mmap
 import threading
+import time
+import collections
 import urllib2
+import urlparse
 import base64
 import uuid
 import logger
+from HttpClient import HttpClient
+
+READ_LEN = 512 * 1024
+CHUNK_SIZE = 8 << 20        # 默认下载块大小
+MIN_STEAL_SIZE = 1 << 20    # 剩余字节数不小于2倍该值的块才会被拆分
+MAX_CHUNK_RETRIES = 3       # 单个块失败后的最大重试次数
+PROGRESS_INTERVAL = 5.0     # 进度采样及回调的间隔(秒)
+PROGRESS_EMA_ALPHA = 0.3    # 平均速度的指数滑动平均系数
+HASH_READ_LEN = 1 << 20     # 计算摘要时每次读取的字节数
+DIGEST_ALGORITHMS = {'MD5': 'md5', 'SHA': 'sha1', 'SHA-256': 'sha256', 'SHA-512': 'sha512'}
+SPLIT_SIZE = 32 << 20       # DownloadManager中小于该大小的文件整体下载，不切分
+MIRROR_MAX_FAILURES = 3     # 镜像连续失败该次数后不再使用
+MIRROR_SLOW_RATIO = 0.1     # 速度低于最快镜像该比例的镜像不再使用
+MIRROR_MIN_SAMPLE = 4 << 20 # 镜像下载超过该字节数后才参与慢速判断
+MIRROR_MIN_TIME = 1e-3      # 计算镜像速度时耗时的下限(秒)，避免计时精度不足时速度为无穷大
+ADAPT_INTERVAL = 2.0        # 自适应并发的采样间隔(秒)
+ADAPT_GAIN = 0.05           # 吞吐量提升超过该比例才继续增加连接
+ADAPT_COOLDOWN = 5          # 并发稳定后经过多少个采样周期再次尝试增加连接
+JOURNAL_SUFFIX = '.journal'
 
 
 class RepeatTimer(threading.Thread):
@@ -27,26 +57,666 @@ class RepeatTimer(threading.Thread):
         self.stopped.set()
 
 
+class RangeSet(object):
+    '''线程安全的字节区间集合，相邻或重叠的区间自动合并'''
+
+    def __init__(self, ranges=()):
+        self._ranges = []  # [[start, end], ...]，有序且互不相邻
+        self._lock = threading.Lock()
+        for start, end in ranges:
+            self.add(start, end)
+
+    def add(self, start, end):
+        '''加入区间[start, end]'''
+        with self._lock:
+            ranges = self._ranges
+            i = bisect.bisect_left(ranges, [start, end])
+            # 与前一个区间相邻或重叠时合并
+            if i > 0 and ranges[i - 1][1] >= start - 1:
+                i -= 1
+                ranges[i][1] = max(ranges[i][1], end)
+            else:
+                ranges.insert(i, [start, end])
+            # 合并后续被覆盖或相邻的区间
+            while i + 1 < len(ranges) and ranges[i + 1][0] <= ranges[i][1] + 1:
+                ranges[i][1] = max(ranges[i][1], ranges.pop(i + 1)[1])
+
+    def ranges(self):
+        with self._lock:
+            return [list(r) for r in self._ranges]
+
+    def total(self):
+        with self._lock:
+            return sum(e - s + 1 for s, e in self._ranges)
+
+    def prefix_end(self):
+        '''从0开始连续覆盖的字节数'''
+        with self._lock:
+            if self._ranges and self._ranges[0][0] == 0:
+                return self._ranges[0][1] + 1
+            return 0
+
+    def missing(self, size):
+        '''返回[0, size)中不在集合内的区间列表[(start, end), ...]'''
+        with self._lock:
+            result, pos = [], 0
+            for s, e in self._ranges:
+                if s > pos:
+                    result.append((pos, s - 1))
+                pos = max(pos, e + 1)
+            if pos < size:
+                result.append((pos, size - 1))
+            return result
+
+
+class DownloadJournal(object):
+    '''
+    断点续传日志，记录目标文件中已下载完成的字节区间
+    日志文件与目标文件放在一起(dstfile.journal)，以ETag/Last-Modified/文件大小校验服务器文件是否变化
+    保存时先fsync数据文件再原子替换日志文件，保证日志中记录的区间一定已落盘
+    '''
+
+    def __init__(self, dstfile):
+        self.dstfile = dstfile
+        self.path = dstfile + JOURNAL_SUFFIX
+        self.url = None
+        self.filesize = 0
+        self.etag = None
+        self.last_modified = None
+        self.done = RangeSet()  # 已完成区间
+
+    def load(self):
+        '''加载日志文件，不存在或格式错误时返回False'''
+        try:
+            with open(self.path, 'r') as fp:
+                data = json.load(fp)
+            self.url = data['url']
+            self.filesize = data['filesize']
+            self.etag = data.get('etag')
+            self.last_modified = data.get('last_modified')
+            self.done = RangeSet(data['done'])
+        except (IOError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def matches(self, filesize, etag, last_modified):
+        '''检查服务器文件与日志记录的是否一致，且目标文件存在'''
+        return (self.filesize == filesize and self.etag == etag and
+                self.last_modified == last_modified and
+                os.path.exists(self.dstfile) and os.path.getsize(self.dstfile) == filesize)
+
+    def reset(self, url, filesize, etag, last_modified):
+        self.url = url
+        self.filesize = filesize
+        self.etag = etag
+        self.last_modified = last_modified
+        self.done = RangeSet()
+
+    def add(self, start, end):
+        '''记录区间[start, end]已下载完成'''
+        self.done.add(start, end)
+
+    def done_bytes(self):
+        return self.done.total()
+
+    def missing(self):
+        '''返回尚未下载的区间列表[(start, end), ...]'''
+        return self.done.missing(self.filesize)
+
+    def save(self):
+        '''先将数据文件落盘，再原子地替换日志文件'''
+        data = {'url': self.url, 'filesize': self.filesize, 'etag': self.etag,
+                'last_modified': self.last_modified, 'done': self.done.ranges()}
+        fd = os.open(self.dstfile, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(data, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class PrefixHasher(threading.Thread):
+    '''
+    与下载并行计算整个文件的摘要
+    记录已写入的区间，后台线程跟随从0开始的连续已写入前缀读取并计算摘要，
+    刚写入的数据仍在页缓存中，下载结束时摘要也基本算完，不需要再完整读一遍磁盘
+    '''
+
+    def __init__(self, path, filesize, algorithm, written=()):
+        super(PrefixHasher, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.filesize = filesize
+        self.algorithm = algorithm
+        self._hash = hashlib.new(algorithm)
+        self._written = RangeSet(written)
+        self._pos = 0
+        self._stopped = False
+        self._cond = threading.Condition()
+
+    def add(self, start, end):
+        '''记录区间[start, end]已写入文件'''
+        self._written.add(start, end)
+        if start <= self._pos:
+            with self._cond:
+                self._cond.notify()
+
+    def run(self):
+        # 不使用缓冲，避免预读到尚未写入的数据
+        with open(self.path, 'rb', 0) as fp:
+            while self._pos < self.filesize:
+                with self._cond:
+                    while not self._stopped and self._written.prefix_end() <= self._pos:
+                        self._cond.wait(0.5)
+                    if self._stopped:
+                        return
+                end = min(self._written.prefix_end(), self.filesize)
+                fp.seek(self._pos)
+                while self._pos < end:
+                    data = fp.read(min(HASH_READ_LEN, end - self._pos))
+                    if not data:
+                        raise IOError('Unexpected end of file at %d' % self._pos)
+                    self._hash.update(data)
+                    self._pos += len(data)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def hexdigest(self):
+        '''等待摘要计算完成并返回十六进制摘要，未完成时返回None'''
+        self.join()
+        return self._hash.hexdigest() if self._pos >= self.filesize else None
+
+
+def _load_libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):
+        return None
+
+_libc = _load_libc()
+
+
+def _pwrite_libc(fd, data, offset):
+    '''Python 2没有os.pwrite，通过libc调用pwrite'''
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    if isinstance(data, bytearray):
+        buf = (ctypes.c_char * len(data)).from_buffer(data)
+    else:
+        buf = data
+    n = _libc.pwrite(fd, buf, ctypes.c_size_t(len(data)), ctypes.c_int64(offset))
+    if n < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return n
+
+
+def posix_fallocate(fd, offset, length):
+    '''为文件预分配磁盘块，不支持时返回False'''
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(fd, offset, length)
+        return True
+    func = getattr(_libc, 'posix_fallocate64', None) or getattr(_libc, 'posix_fallocate', None)
+    if func is None:
+        return False
+    err = func(fd, ctypes.c_int64(offset), ctypes.c_int64(length))
+    if err in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+        return False
+    if err:
+        raise OSError(err, os.strerror(err))
+    return True
+
+
+class SeekWriter(object):
+    '''每个线程使用独立的无缓冲文件句柄，seek后写入'''
+
+    def __init__(self, path, filesize):
+        self.path = path
+        self._local = threading.local()
+        self._files = []
+        self._lock = threading.Lock()
+
+    def write(self, pos, data):
+        fp = getattr(self._local, 'fp', None)
+        if fp is None:
+            fp = self._local.fp = open(self.path, 'rb+', 0)
+            with self._lock:
+                self._files.append(fp)
+        fp.seek(pos)
+        fp.write(data)
+
+    def close(self):
+        with self._lock:
+            files, self._files = self._files, []
+        for fp in files:
+            fp.close()
+
+
+class PwriteWriter(object):
+    '''所有线程共享一个文件描述符，通过pwrite按位置写入，无需seek和加锁'''
+
+    def __init__(self, path, filesize):
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY)
+        self._pwrite = getattr(os, 'pwrite', None) or _pwrite_libc
+
+    def write(self, pos, data):
+        while len(data):
+            n = self._pwrite(self._fd, data, pos)
+            pos += n
+            data = data[n:]
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class MmapWriter(object):
+    '''将目标文件映射到内存，所有线程直接写入映射区域，要求文件大小已知'''
+
+    def __init__(self, path, filesize):
+        self.path = path
+        self._fp = open(path, 'rb+')
+        self._mm = mmap.mmap(self._fp.fileno(), filesize, access=mmap.ACCESS_WRITE)
+
+    def write(self, pos, data):
+        self._mm[pos:pos + len(data)] = data
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm.close()
+            self._fp.close()
+            self._mm = None
+
+
+WRITERS = {'seek': SeekWriter, 'pwrite': PwriteWriter, 'mmap': MmapWriter}
+
+
+class DownloadProgress(object):
+    '''
+    下载进度统计
+    每个线程只累加自己的计数器，读取时再求和，数据路径上不需要加锁；
+    sample()计算瞬时速度、滑动平均速度和剩余时间，并通知注册的观察者
+    '''
+
+    def __init__(self, total_size=0, parent=None):
+        self.total_size = total_size
+        self.parent = parent    # 汇总多个下载任务进度的DownloadProgress
+        self._base = 0
+        self._local = threading.local()
+        self._counters = []
+        self._lock = threading.Lock()
+        self._observers = []
+        self._start_time = time.time()
+        self._last_time = self._start_time
+        self._last_bytes = 0
+        self._avg_speed = None
+
+    def reset(self, total_size, base=0):
+        '''设置文件大小和已完成的字节数(断点续传时)'''
+        with self._lock:
+            self.total_size = total_size
+            self._base = base
+            for counter in self._counters:
+                counter[0] = 0
+            self._start_time = self._last_time = time.time()
+            self._last_bytes = base
+            self._avg_speed = None
+
+    def extend(self, total_size, base=0):
+        '''汇总进度中加入一个下载任务'''
+        with self._lock:
+            self.total_size += total_size
+            self._base += base
+
+    def add(self, nbytes):
+        '''累加当前线程接收的字节数'''
+        counter = getattr(self._local, 'counter', None)
+        if counter is None:
+            counter = self._local.counter = [0]
+            with self._lock:
+                self._counters.append(counter)
+        counter[0] += nbytes
+        if self.parent is not None:
+            self.parent.add(nbytes)
+
+    @property
+    def recv_bytes(self):
+        return self._base + sum(counter[0] for counter in self._counters)
+
+    def add_observer(self, func):
+        '''注册观察者，每次采样时调用func(snapshot)'''
+        self._observers.append(func)
+
+    def remove_observer(self, func):
+        self._observers.remove(func)
+
+    def sample(self):
+        '''
+        采样当前进度并通知观察者，返回快照字典:
+        recv_bytes、total_size(未知为0)、percent(未知为None)、speed(瞬时速度，字节/秒)、
+        avg_speed(滑动平均速度)、elapsed(已用时间)、eta(预计剩余时间，未知为None)
+        '''
+        with self._lock:
+            now, recv = time.time(), self.recv_bytes
+            interval = max(now - self._last_time, 1e-6)
+            speed = (recv - self._last_bytes) / interval
+            if self._avg_speed is None:
+                self._avg_speed = speed
+            else:
+                self._avg_speed += PROGRESS_EMA_ALPHA * (speed - self._avg_speed)
+            self._last_time, self._last_bytes = now, recv
+            snapshot = self._snapshot(now, recv, speed, self._avg_speed)
+        for func in list(self._observers):
+            try:
+                func(snapshot)
+            except Exception as e:
+                logger.error('Progress observer error: {}'.format(e), logtrace=True)
+        return snapshot
+
+    def snapshot(self):
+        '''返回当前进度快照，不更新速度统计'''
+        with self._lock:
+            return self._snapshot(time.time(), self.recv_bytes, None, self._avg_speed)
+
+    def _snapshot(self, now, recv, speed, avg_speed):
+        total = self.total_size
+        percent = eta = None
+        if total > 0:
+            percent = min(recv * 100.0 / total, 100.0)
+            if avg_speed:
+                eta = max(total - recv, 0) / avg_speed
+        return {'recv_bytes': recv, 'total_size': total, 'percent': percent,
+                'speed': speed, 'avg_speed': avg_speed or 0.0,
+                'elapsed': now - self._start_time, 'eta': eta}
+
+
+def _speed(stats):
+    '''镜像的实测速度(字节/秒)'''
+    return stats['bytes'] / max(stats['time'], MIRROR_MIN_TIME)
+
+
+class MirrorSet(object):
+    '''
+    镜像选择器
+    按各镜像的实测速度分配下载块：未测速(还没有完成过请求)的镜像优先，其中进行中请求数最少的优先；
+    都已测速时选择"速度/(进行中请求数+1)"最大的镜像，使请求数与各镜像的速度成正比；
+    连续失败或明显慢于最快镜像的镜像自动剔除
+    '''
+
+    def __init__(self, urls):
+        self._stats = collections.OrderedDict(
+            (url, {'bytes': 0, 'time': 0.0, 'samples': 0, 'failures': 0, 'active': 0, 'enabled': True})
+            for url in urls)
+        self._lock = threading.Lock()
+
+    def urls(self):
+        with self._lock:
+            return [url for url, s in self._stats.items() if s['enabled']]
+
+    def acquire(self):
+        '''选择一个镜像用于下一次请求'''
+        with self._lock:
+            best, best_score = None, None
+            for url, s in self._stats.items():
+                if not s['enabled']:
+                    continue
+                if s['samples']:
+                    score = (0, _speed(s) / (s['active'] + 1))
+                else:
+                    score = (1, -s['active'])
+                if best is None or score > best_score:
+                    best, best_score = url, score
+            self._stats[best]['active'] += 1
+            return best
+
+    def release(self, url, nbytes, elapsed, ok=True):
+        '''记录一次请求的结果'''
+        with self._lock:
+            s = self._stats[url]
+            s['active'] -= 1
+            s['bytes'] += nbytes
+            s['time'] += elapsed
+            s['samples'] += 1
+            s['failures'] = 0 if ok else s['failures'] + 1
+            if not ok and s['failures'] >= MIRROR_MAX_FAILURES:
+                self._disable(url, '%d consecutive failures' % s['failures'])
+            self._drop_slow()
+
+    def remove(self, url, reason):
+        with self._lock:
+            self._disable(url, reason)
+
+    def get_stats(self):
+        '''返回各镜像的统计信息{url: {bytes, time, samples, speed, failures, enabled}}'''
+        with self._lock:
+            return dict((url, dict(s, speed=_speed(s) if s['samples'] else 0.0))
+                        for url, s in self._stats.items())
+
+    def _disable(self, url, reason):
+        enabled = [u for u, s in self._stats.items() if s['enabled']]
+        if url in enabled and len(enabled) > 1:
+            self._stats[url]['enabled'] = False
+            logger.info('Mirror %s removed: %s' % (url, reason))
+
+    def _drop_slow(self):
+        speeds = dict((url, _speed(s)) for url, s in self._stats.items()
+                      if s['enabled'] and s['bytes'] >= MIRROR_MIN_SAMPLE)
+        if len(speeds) < 2:
+            return
+        fastest = max(speeds.values())
+        for url, speed in speeds.items():
+            if speed < fastest * MIRROR_SLOW_RATIO:
+                self._disable(url, 'too slow, %.1f KB/s' % (speed / 1024))
+
+
+class Chunk(object):
+    '''下载块，区间为[start, end]，pos为下一个要写入的位置，end可能因被拆分而缩小'''
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.pos = start
+        self.reserved = start   # 已分配给正在进行的读操作的位置，拆分点不能小于该值
+        self.worker = None
+        self.retries = 0
+        self.started = None
+
+    def remain(self):
+        return self.end - self.pos + 1
+
+
+class ChunkScheduler(object):
+    '''
+    动态分块调度器
+    待下载区间切分成多个块放入共享队列，空闲线程取下一个块；
+    队列为空时拆分剩余字节最多的进行中块，后半部分交给空闲线程(work stealing)
+    '''
+
+    def __init__(self, ranges, chunk_size=CHUNK_SIZE, min_steal=MIN_STEAL_SIZE, splittable=True):
+        '''
+        ranges - 待下载区间列表[(start, end), ...]，end小于start表示大小未知
+        chunk_size - 块大小
+        min_steal - 剩余字节数不小于2倍该值的块才会被拆分
+        splittable - 服务器是否支持Range，不支持时每个区间作为一个块整体下载，失败后从头重试
+        '''
+        self.splittable = splittable
+        self.chunk_size = max(int(chunk_size), 1)
+        self.min_steal = max(int(min_steal), 1)
+        self.stats = []     # 已完成块的统计信息
+        self.failed = False
+        self._pending = collections.deque()
+        self._active = set()
+        self._lock = threading.Lock()
+        for start, end in ranges:
+            if end < start or not splittable:
+                # 不支持Range或文件大小未知，整体下载到连接关闭为止
+                self._pending.append(Chunk(start, end))
+                continue
+            for s in range(start, end + 1, self.chunk_size):
+                self._pending.append(Chunk(s, min(s + self.chunk_size - 1, end)))
+
+    def next(self, worker):
+        '''为worker分配下一个块，没有可下载的块时返回None'''
+        with self._lock:
+            chunk = self._pending.popleft() if self._pending else self._steal()
+            if chunk is not None:
+                chunk.worker, chunk.started = worker, time.time()
+                self._active.add(chunk)
+            return chunk
+
+    def _steal(self):
+        victims = [c for c in self._active if c.end >= c.start]
+        if not victims or not self.splittable:
+            return None
+        victim = max(victims, key=lambda c: c.end - c.reserved)
+        remain = victim.end - victim.reserved + 1
+        if remain < 2 * self.min_steal:
+            return None
+        mid = victim.reserved + remain // 2
+        chunk = Chunk(mid, victim.end)
+        victim.end = mid - 1
+        logger.debug('Split chunk of worker %s at %d, stolen range: %d-%d',
+                     victim.worker, mid, chunk.start, chunk.end)
+        return chunk
+
+    def idle(self):
+        '''没有待下载和进行中的块'''
+        with self._lock:
+            return not self._pending and not self._active
+
+    def reserve(self, chunk, size):
+        '''预留接下来要读取的字节数，返回0表示块已下载完成'''
+        with self._lock:
+            if chunk.end < chunk.start:
+                n = size
+            else:
+                n = max(min(size, chunk.end - chunk.pos + 1), 0)
+            chunk.reserved = chunk.pos + n
+            return n
+
+    def rewind(self, chunk, pos):
+        '''区间数据无效，将块的下载位置退回pos'''
+        with self._lock:
+            chunk.pos = chunk.reserved = pos
+
+    def advance(self, chunk, size):
+        with self._lock:
+            chunk.pos += size
+
+    def finish(self, chunk):
+        with self._lock:
+            self._active.discard(chunk)
+            self.stats.append({'start': chunk.start, 'end': chunk.pos - 1,
+                               'bytes': chunk.pos - chunk.start, 'worker': chunk.worker,
+                               'elapsed': time.time() - chunk.started})
+
+    def retry(self, chunk):
+        '''块下载失败，剩余部分重新放回队列，超过重试次数时返回False'''
+        with self._lock:
+            self._active.discard(chunk)
+            chunk.retries += 1
+            if chunk.retries > MAX_CHUNK_RETRIES:
+                self.failed = True
+                return False
+            if chunk.pos > chunk.start:
+                self.stats.append({'start': chunk.start, 'end': chunk.pos - 1,
+                                   'bytes': chunk.pos - chunk.start, 'worker': chunk.worker,
+                                   'elapsed': time.time() - chunk.started})
+            # 不支持Range时无法从中间续传，从头开始重新下载
+            retry = Chunk(chunk.pos if self.splittable else chunk.start, chunk.end)
+            retry.retries = chunk.retries
+            self._pending.appendleft(retry)
+            return True
+
+
 class MultiThreadDownloader(object):
     '''
     多线程下载器
     当HTTP服务器支持Range时，启用多线程下载，否则单线程下载
     '''
 
-    def __init__(self, url, dstfile, threadnum=5, timeout=30):
+    def __init__(self, url, dstfile, threadnum=5, timeout=30, resume=False, chunk_size=CHUNK_SIZE,
+                 adaptive=False, min_threads=1, max_threads=32, write_mode='pwrite', preallocate=False,
+                 http_client=None, checksum=None):
         '''
-        url - 要下载的文件对应的url
+        url - 要下载的文件对应的url，也可以是内容相同的多个镜像url列表
         dstfile - 下载到本地的文件保存路径
-        threadnum - 下载线程数
+        threadnum - 下载线程数，自适应模式下为初始线程数
         timeout - 超时时间，HTTP响应超过该时间认为失败，默认30s超时
+        resume - 是否断点续传，为True时根据dstfile.journal只下载未完成的区间
+        chunk_size - 下载块大小，各线程从共享队列中动态领取块
+        adaptive - 是否根据吞吐量自动调整下载线程数
+        min_threads, max_threads - 自适应模式下的线程数范围
+        write_mode - 写文件方式: seek(每线程独立句柄)、pwrite(共享文件描述符)、mmap(内存映射)
+        preallocate - 是否用posix_fallocate预分配磁盘块，否则创建稀疏文件
+        http_client - 用于发送请求的HttpClient，可在多个下载任务间复用长连接，默认每次请求新建连接
+        checksum - 期望的文件摘要，格式为'算法:十六进制摘要'，如'sha256:ab12...'，
+                   未指定时使用服务器返回的Digest或Content-MD5头，均没有时不校验
         '''
-        self.url = url
+        if write_mode not in WRITERS:
+            raise ValueError('Unknown write mode: %s' % write_mode)
+        self.urls = list(url) if isinstance(url, (list, tuple)) else [url]
+        self.url = self.urls[0]
         self.dstfile = dstfile
         self.threadnum = max(int(threadnum), 1)
         self.timeout = int(timeout or 30)
+        self.resume = resume
+        self.chunk_size = chunk_size
+        self.write_mode = write_mode
+        self.preallocate = preallocate
         self.filesize = 0
-        self.recv_bytes = 0
+        self.etag = None
+        self.last_modified = None
+        self.progress = DownloadProgress()
+        self.http_client = http_client
+        self.checksum = checksum
+        self.digest = None
+        self._digest_headers = {}
+        self._hasher = None
         self.auth = None
+        self._support_range = False
+        self._journal = None
+        self._scheduler = None
+        self._writer = None
+        self._mirrors = None
+        self._failed = False
+        self.adaptive = adaptive
+        self.min_threads = max(int(min_threads), 1)
+        self.max_threads = max(int(max_threads), self.min_threads)
+        self._threads = []
+        self._workers = 0       # 正在运行的下载线程数
+        self._retire = 0        # 等待退出的下载线程数
+        self._errors = 0        # 请求失败次数(含5xx)
+        self._worker_lock = threading.Lock()
+        self._joined = False
+        self._adapt = None
+
+    @property
+    def recv_bytes(self):
+        '''已接收的字节数'''
+        return self.progress.recv_bytes
+
+    def add_progress_callback(self, func):
+        '''
+        注册进度回调，每PROGRESS_INTERVAL秒调用一次func(snapshot)，
+        snapshot字段见DownloadProgress.sample
+        '''
+        self.progress.add_observer(func)
 
     def set_base_auth_info(self, auth=None):
         '''
@@ -58,38 +728,211 @@ class MultiThreadDownloader(object):
     def download(self):
         '''下载文件'''
         try:
-            if not self._is_server_support_range():
-                self.threadnum = 1  # 采用单线程下载
-                logger.info('Server does not support multi-threaded download, use single thread')
-
-            logger.info('Filesize: %d, download thread number: %d' % (self.filesize, self.threadnum))
-            self._create_file()
-
-            threads = []
-            # 向上取整
-            part = (self.filesize - 1) // self.threadnum + 1
+            self._prepare()
+            if self.adaptive and self._support_range:
+                self.threadnum = min(max(self.threadnum, self.min_threads), self.max_threads)
+                self._adapt = {'time': time.time(), 'bytes': self.recv_bytes, 'errors': 0,
+                               'tput': 0.0, 'probing': False, 'cooldown': 0}
             for i in range(self.threadnum):
-                start = part * i
-                end = min(self.filesize, start + part) - 1
-                logger.debug('thread %d download range: %d-%d' % (i, start, end))
-                t = threading.Thread(
-                    target=self._handler, kwargs={'idx': i,
-                                                  'start': start,
-                                                  'end': end})
-                t.start()
-                threads.append(t)
-
-            timer = RepeatTimer(5.0, self._print_progress)
-            timer.start()
-            for t in threads:
-                t.join()
-            timer.cancel()
-            logger.info('Download progress: 100%%, %d/%d' % (self.recv_bytes, self.filesize))
+                self._start_worker()
+
+            timers = [RepeatTimer(PROGRESS_INTERVAL, self._on_timer)]
+            if self._adapt:
+                timers.append(RepeatTimer(ADAPT_INTERVAL, self._adjust_concurrency))
+            for timer in timers:
+                timer.start()
+            try:
+                self._join_workers()
+            finally:
+                # cancel不会等待正在执行的回调，需等其结束，避免保存断点续传日志与_finish竞争
+                for timer in timers:
+                    timer.cancel()
+                    timer.join()
+            return self._finish()
         except Exception as e:
             logger.error('Download error: {}'.format(e), logtrace=True)
             return False
+
+    def _prepare(self, split_size=None):
+        '''
+        探测服务器、创建目标文件，并初始化块调度器和写文件对象
+        split_size - 文件小于该大小时整体下载，不切分成块
+        '''
+        if not self._is_server_support_range():
+            self.threadnum = 1  # 采用单线程下载
+            logger.info('Server does not support multi-threaded download, use single thread')
+
+        logger.info('Filesize: %d, download thread number: %d' % (self.filesize, self.threadnum))
+        if len(self.urls) > 1 and self._support_range:
+            self._mirrors = MirrorSet([self.url] + [url for url in self.urls[1:] if self._check_mirror(url)])
+        self.progress.reset(self.filesize)
+        ranges = self._prepare_ranges()
+        if split_size and self.filesize < split_size:
+            self._scheduler = ChunkScheduler(ranges, max(self.filesize, 1), splittable=False)
+        else:
+            self._scheduler = ChunkScheduler(ranges, self.chunk_size, splittable=self._support_range)
+        self._writer = self._create_writer()
+        self._start_hasher()
+
+    def _expected_digest(self):
+        '''返回期望的(算法, 十六进制摘要)，没有时返回None'''
+        if self.checksum:
+            algorithm, _, hexdigest = self.checksum.partition(':')
+            return algorithm.lower().replace('-', ''), hexdigest.lower()
+        for part in (self._digest_headers.get('Digest') or '').split(','):
+            name, _, value = part.strip().partition('=')
+            if name.upper() in DIGEST_ALGORITHMS and value:
+                return DIGEST_ALGORITHMS[name.upper()], base64.b64decode(value).encode('hex')
+        content_md5 = self._digest_headers.get('Content-MD5')
+        if content_md5:
+            return 'md5', base64.b64decode(content_md5).encode('hex')
+        return None
+
+    def _start_hasher(self):
+        expected = self._expected_digest()
+        if expected is None or self.filesize <= 0:
+            return
+        written = self._journal.done.ranges() if self._journal else ()
+        self._hasher = PrefixHasher(self.dstfile, self.filesize, expected[0], written)
+        self._hasher.start()
+
+    def _verify_digest(self):
+        '''校验文件摘要，不一致时删除断点续传日志，下次重新完整下载'''
+        algorithm, expected = self._expected_digest()
+        self.digest = self._hasher.hexdigest()
+        if self.digest == expected:
+            logger.info('Checksum verified, %s: %s' % (algorithm, self.digest))
+            return True
+        logger.error('Checksum mismatch, %s expected: %s, actual: %s' % (algorithm, expected, self.digest),
+                     logtrace=False)
+        if self._journal:
+            self._journal.remove()
+        return False
+
+    def _mark_written(self, start, end):
+        '''区间[start, end]已写入文件'''
+        if self._journal:
+            self._journal.add(start, end)
+        if self._hasher:
+            self._hasher.add(start, end)
+
+    def _finish(self):
+        '''所有块下载结束后关闭文件，下载失败时保存断点续传日志，返回是否成功'''
+        self._writer.close()
+        self._log_chunk_stats()
+        if self._failed or self._scheduler.failed:
+            if self._hasher:
+                self._hasher.stop()
+            if self._journal:
+                self._journal.save()
+                logger.info('Download incomplete, journal saved to %s' % self._journal.path)
+            return False
+        if self._hasher and not self._verify_digest():
+            return False
+        if self._journal:
+            self._journal.remove()
+        self._print_progress()
         return True
 
+    def _prepare_ranges(self):
+        '''创建目标文件，返回需要下载的区间列表，断点续传时只返回未完成的区间'''
+        if not self._support_range or self.filesize <= 0:
+            self._create_file()
+            return [(0, self.filesize - 1)]
+
+        if self.resume:
+            self._journal = DownloadJournal(self.dstfile)
+            if self._journal.load() and self._journal.matches(self.filesize, self.etag, self.last_modified):
+                self.progress.reset(self.filesize, self._journal.done_bytes())
+                logger.info('Resume download, %d/%d bytes already downloaded' % (self.recv_bytes, self.filesize))
+                return self._journal.missing()
+            self._journal.reset(self.url, self.filesize, self.etag, self.last_modified)
+            self._create_file()
+            self._journal.save()
+        else:
+            self._create_file()
+        return [(0, self.filesize - 1)]
+
+    def _start_worker(self):
+        with self._worker_lock:
+            if self._joined:
+                return
+            idx = len(self._threads)
+            t = threading.Thread(target=self._handler, kwargs={'idx': idx})
+            self._threads.append(t)
+            self._workers += 1
+        t.start()
+
+    def _join_workers(self):
+        '''等待所有下载线程结束，自适应模式下线程列表会动态增长'''
+        while True:
+            with self._worker_lock:
+                alive = [t for t in self._threads if t.is_alive()]
+                if not alive:
+                    self._joined = True
+                    break
+            alive[0].join(1.0)
+
+    def _should_retire(self):
+        '''自适应模式减少并发时，让当前线程在块边界退出'''
+        with self._worker_lock:
+            if self._retire > 0 and self._workers > self.min_threads:
+                self._retire -= 1
+                return True
+        return False
+
+    def _adjust_concurrency(self):
+        '''
+        根据采样周期内的总吞吐量调整线程数：
+        出现请求错误时减少一个线程；增加线程后吞吐量继续上升则继续增加，不再上升时停止增加，
+        下降时撤回上次增加的线程，并在若干周期后重新尝试
+        '''
+        state = self._adapt
+        with self._worker_lock:
+            errors, workers = self._errors, self._workers - self._retire
+        now, recv = time.time(), self.recv_bytes
+        tput = (recv - state['bytes']) / max(now - state['time'], 1e-6)
+        new_errors = errors - state['errors']
+        last_tput, probing = state['tput'], state['probing']
+        state.update(time=now, bytes=recv, errors=errors, tput=tput, probing=False)
+
+        if new_errors:
+            state['cooldown'] = ADAPT_COOLDOWN
+            if workers > self.min_threads:
+                with self._worker_lock:
+                    self._retire += 1
+                logger.info('Adaptive: %d request errors, decrease threads to %d' % (new_errors, workers - 1))
+            return
+        if probing and tput < last_tput * (1 + ADAPT_GAIN):
+            # 增加线程后吞吐量没有明显提升
+            state['cooldown'] = ADAPT_COOLDOWN
+            if tput < last_tput * (1 - ADAPT_GAIN) and workers > self.min_threads:
+                with self._worker_lock:
+                    self._retire += 1
+                logger.info('Adaptive: throughput dropped to %.1f KB/s, decrease threads to %d' % (
+                    tput / 1024, workers - 1))
+            return
+        if state['cooldown'] > 0:
+            state['cooldown'] -= 1
+            return
+        if workers < self.max_threads:
+            state['probing'] = True
+            self._start_worker()
+            logger.info('Adaptive: throughput %.1f KB/s (%.1f KB/s per thread), increase threads to %d' % (
+                tput / 1024, tput / 1024 / max(workers, 1), workers + 1))
+
+    def get_chunk_stats(self):
+        '''返回各下载块的统计信息列表，每项包含start、end、bytes、worker、elapsed'''
+        return list(self._scheduler.stats) if self._scheduler else []
+
+    def _log_chunk_stats(self):
+        stats = self.get_chunk_stats()
+        if not stats:
+            return
+        elapsed = sorted(s['elapsed'] for s in stats)
+        logger.info('Chunk stats: count %d, elapsed min %.2fs, median %.2fs, max %.2fs' % (
+            len(elapsed), elapsed[0], elapsed[len(elapsed) // 2], elapsed[-1]))
+
     def _request(self, method, url, headers={}, auth=None, timeout=30):
         '''发起HTTP请求'''
         req = urllib2.Request(url)
@@ -102,12 +945,19 @@ class MultiThreadDownloader(object):
         uuid_str = uuid.uuid1()
         rsp = None
         try:
-            logger.debug('Request(uuid:%s):\n%s' % (uuid_str, self._req2str(req)))
-            rsp = urllib2.urlopen(req, timeout=timeout)
-            logger.debug('Response(uuid:%s):\n%s' % (uuid_str, rsp.info()))
+            logger.debug(lambda: 'Request(uuid:%s):\n%s' % (uuid_str, self._req2str(req)))
+            if self.http_client:
+                rsp = self.http_client.urlopen(req, timeout=timeout)
+            else:
+                rsp = urllib2.urlopen(req, timeout=timeout)
+            logger.debug('Response(uuid:%s):\n%s', uuid_str, rsp.info())
         except urllib2.HTTPError, e:
+            with self._worker_lock:
+                self._errors += 1
             logger.error('HTTP request error:\n{} {}\r\n{}'.format(e.code, e.msg, e.hdrs), logtrace=False)
         except Exception, e:
+            with self._worker_lock:
+                self._errors += 1
             logger.error('Exception: {}'.format(e), logtrace=True)
         return rsp
 
@@ -117,7 +967,10 @@ class MultiThreadDownloader(object):
         rsp = self._request('HEAD', self.url, headers={'Range': 'bytes=0-99'}, auth=self.auth, timeout=self.timeout)
         # 当http服务器返回的Content-Length等于请求的长度时，支持Range
         content_len = int(rsp.info().get('Content-Length', 0))
+        self._save_validators(rsp)
+        rsp.close()
         is_support = (content_len == 100)
+        self._support_range = is_support
         if is_support:
             self._get_file_size()  # 再获取一次文件大小
         elif content_len > 100:
@@ -128,35 +981,150 @@ class MultiThreadDownloader(object):
         '''通过HEAD指令获取文件大小，服务器不返回Content-Length时，文件大小为0'''
         rsp = self._request('HEAD', self.url, auth=self.auth, timeout=self.timeout)
         self.filesize = int(rsp.info().get('Content-Length', 0))
+        self._save_validators(rsp)
+        rsp.close()
+
+    def _check_mirror(self, url):
+        '''检查镜像是否支持Range且文件大小、ETag与主url一致'''
+        rsp = self._request('HEAD', url, headers={'Range': 'bytes=0-99'}, auth=self.auth, timeout=self.timeout)
+        if rsp is None:
+            return False
+        range_len = int(rsp.info().get('Content-Length', 0))
+        rsp.close()
+        rsp = self._request('HEAD', url, auth=self.auth, timeout=self.timeout)
+        if rsp is None:
+            return False
+        filesize, etag = int(rsp.info().get('Content-Length', 0)), rsp.info().get('ETag')
+        rsp.close()
+        if range_len != 100 or filesize != self.filesize or (etag and self.etag and etag != self.etag):
+            logger.info('Mirror %s ignored: range %s, filesize %d/%d, etag %s/%s' % (
+                url, range_len == 100, filesize, self.filesize, etag, self.etag))
+            return False
+        return True
+
+    def get_mirror_stats(self):
+        '''返回各镜像的下载统计信息'''
+        return self._mirrors.get_stats() if self._mirrors else {}
+
+    def _save_validators(self, rsp):
+        '''记录用于断点续传校验的ETag和Last-Modified，以及完整文件的Digest/Content-MD5'''
+        self.etag = rsp.info().get('ETag')
+        self.last_modified = rsp.info().get('Last-Modified')
+        if rsp.getcode() != 206:
+            self._digest_headers = dict((k, rsp.info().get(k)) for k in ('Digest', 'Content-MD5'))
 
     def _create_file(self):
         '''创建一个和要下载文件一样大小的文件'''
         with open(self.dstfile, "wb") as fp:
+            if self.preallocate and self.filesize > 0 and posix_fallocate(fp.fileno(), 0, self.filesize):
+                return
             fp.truncate(self.filesize)
 
-    def _handler(self, idx, start, end):
-        '''下载处理函数'''
+    def _create_writer(self):
+        '''创建写文件对象，文件大小未知时不能使用mmap，缺少pwrite时退化为seek'''
+        mode = self.write_mode
+        if mode == 'mmap' and self.filesize <= 0:
+            mode = 'pwrite'
+        if mode == 'pwrite' and not hasattr(os, 'pwrite') and getattr(_libc, 'pwrite', None) is None:
+            mode = 'seek'
+        logger.debug('Write mode: %s', mode)
+        return WRITERS[mode](self.dstfile, self.filesize)
+
+    def _handler(self, idx):
+        '''下载处理函数，从调度器领取块直到没有可下载的块'''
+        try:
+            self._download_chunks(idx)
+        except Exception as e:
+            self._failed = True
+            logger.error('Download thread %d error: %s' % (idx, e), logtrace=True)
+        finally:
+            with self._worker_lock:
+                self._workers -= 1
+
+    def _download_chunks(self, idx):
+        # 预分配的读缓冲区，响应对象支持readinto时循环复用，避免每块分配新字符串
+        buf = bytearray(READ_LEN)
+        while not self._scheduler.failed:
+            if self._adapt and self._should_retire():
+                logger.info('Download thread %d retired' % (idx))
+                return
+            chunk = self._scheduler.next(idx)
+            if chunk is None:
+                break
+            try:
+                self._fetch_chunk(chunk, buf)
+            except Exception as e:
+                logger.error('Download thread %d chunk %d-%d error: %s' % (
+                    idx, chunk.start, chunk.end, e), logtrace=False)
+                if not self._scheduler.retry(chunk):
+                    raise
+            else:
+                self._scheduler.finish(chunk)
+        logger.info('Download thread %d finished!' % (idx))
+
+    def _fetch_chunk(self, chunk, buf):
+        '''下载块并写入文件，块大小未知(end小于start)时下载到连接关闭为止'''
         headers = {}
-        remain_size = -1
-        if end > start:
-            headers['Range'] = 'bytes=%d-%d' % (start, end)
-            remain_size = end - start + 1
+        if chunk.end >= chunk.start and self._support_range:
+            headers['Range'] = 'bytes=%d-%d' % (chunk.pos, chunk.end)
+
+        if not self._mirrors:
+            return self._fetch_chunk_from(self.url, chunk, buf, headers)
+
+        url = self._mirrors.acquire()
+        start_pos, start_time, ok = chunk.pos, time.time(), False
+        try:
+            self._fetch_chunk_from(url, chunk, buf, headers)
+            ok = True
+        finally:
+            self._mirrors.release(url, chunk.pos - start_pos, time.time() - start_time, ok)
 
-        rsp = self._request('GET', self.url, headers=headers, auth=self.auth, timeout=self.timeout)
+    def _fetch_chunk_from(self, url, chunk, buf, headers):
+        rsp = self._request('GET', url, headers=headers, auth=self.auth, timeout=self.timeout)
+        if rsp is None:
+            raise IOError('Request range %d-%d failed' % (chunk.pos, chunk.end))
 
-        # 写入文件对应位置
-        with open(self.dstfile, "rb+") as fp:
-            fp.seek(start)
+        # 服务器为区间响应提供Content-MD5时，整个区间校验通过后才记录为已完成，失败时重新下载该区间
+        range_md5 = rsp.info().get('Content-MD5') if 'Range' in headers else None
+        md5obj = hashlib.md5() if range_md5 else None
+        start_pos, range_len = chunk.pos, chunk.end - chunk.pos + 1
+
+        readinto = getattr(rsp, 'readinto', None)
+        view = memoryview(buf)
+        try:
             while True:
-                chunk = rsp.read(512 * 1024)
-                data = chunk[:remain_size]
+                size = self._scheduler.reserve(chunk, len(buf))
+                if 0 == size:
+                    break
+                if readinto is not None:
+                    data = view[:readinto(view[:size])]
+                else:
+                    data = rsp.read(size)
                 datalen = len(data)
-                self.recv_bytes += datalen
-                remain_size -= datalen
-                fp.write(chunk)
-                if 0 == remain_size:
-                    logger.info('Download thread %d finished!' % (idx))
+                if 0 == datalen:
+                    if chunk.end >= chunk.start:
+                        raise IOError('Connection closed with %d bytes remaining' % chunk.remain())
                     break
+                self._writer.write(chunk.pos, data)
+                self.progress.add(datalen)
+                if md5obj:
+                    md5obj.update(data)
+                else:
+                    self._mark_written(chunk.pos, chunk.pos + datalen - 1)
+                self._scheduler.advance(chunk, datalen)
+            if md5obj:
+                # 块被拆分后只读取了部分区间，无法校验
+                if chunk.pos - start_pos == range_len and \
+                        base64.b64encode(md5obj.digest()) != range_md5.strip():
+                    raise IOError('Range %d-%d Content-MD5 mismatch' % (start_pos, chunk.pos - 1))
+                self._mark_written(start_pos, chunk.pos - 1)
+        except Exception:
+            if md5obj:
+                self.progress.add(start_pos - chunk.pos)
+                self._scheduler.rewind(chunk, start_pos)
+            raise
+        finally:
+            rsp.close()
 
     def _req2str(self, req):
         return '{} {}\r\n{}\r\n\r\n'.format(req.get_method(),
@@ -164,23 +1132,223 @@ class MultiThreadDownloader(object):
                                                 '{}: {}'.format(k, v)
                                                 for k, v in req.headers.items()))
 
+    def _on_timer(self):
+        self._print_progress()
+        if self._journal:
+            self._journal.save()
+
+    def _print_progress(self):
+        s = self.progress.sample()
+        speed = 'speed: %.1f KB/s, avg: %.1f KB/s' % (s['speed'] / 1024, s['avg_speed'] / 1024)
+        if s['percent'] is None:
+            logger.info('Download progress: %d bytes, %s' % (s['recv_bytes'], speed))
+        else:
+            eta = ', eta: %ds' % s['eta'] if s['eta'] is not None else ''
+            logger.info('Download progress: %2d%%, %d/%d, %s%s' % (
+                s['percent'], s['recv_bytes'], s['total_size'], speed, eta))
+
+
+class DownloadManager(object):
+    '''
+    多文件下载管理器
+    所有文件的下载块由一个全局线程池调度，每个host同时进行的请求数受per_host限制，
+    各文件共享一个长连接池；小于split_size的文件整体下载，大文件切分成块下载
+    '''
+
+    def __init__(self, threadnum=10, per_host=4, timeout=30, split_size=SPLIT_SIZE,
+                 chunk_size=CHUNK_SIZE, **kwargs):
+        '''
+        threadnum - 全局下载线程数
+        per_host - 每个host:port同时进行的最大请求数
+        timeout - 超时时间(秒)
+        split_size - 文件大小不小于该值时才切分成块下载
+        chunk_size - 大文件的下载块大小
+        kwargs - 传给MultiThreadDownloader的其他参数，如resume、write_mode、preallocate
+        '''
+        self.threadnum = max(int(threadnum), 1)
+        self.per_host = max(int(per_host), 1)
+        self.timeout = timeout
+        self.split_size = split_size
+        self.chunk_size = chunk_size
+        self.kwargs = kwargs
+        self.auth = None
+        self.http_client = HttpClient(keep_alive=True, pool_maxsize=self.per_host, timeout=timeout)
+        self.progress = DownloadProgress()
+        self._jobs = []
+        self._inflight = collections.defaultdict(int)
+        self._cond = threading.Condition()
+        self._rr = 0
+
+    def set_base_auth_info(self, auth=None):
+        '''设置所有下载任务的Authorization: Basic认证信息，格式: auth = ('user', 'pwd')'''
+        self.auth = tuple(auth)
+
+    def add(self, url, dstfile):
+        '''添加下载任务，返回对应的MultiThreadDownloader'''
+        dl = MultiThreadDownloader(url, dstfile, 1, self.timeout, chunk_size=self.chunk_size,
+                                   http_client=self.http_client, **self.kwargs)
+        dl.progress.parent = self.progress
+        self._jobs.append(_DownloadJob(dl, urlparse.urlsplit(dl.url).netloc))
+        return dl
+
+    def add_progress_callback(self, func):
+        '''注册汇总进度回调，每PROGRESS_INTERVAL秒调用一次func(snapshot)'''
+        self.progress.add_observer(func)
+
+    def download(self):
+        '''下载所有任务，返回{dstfile: 是否成功}'''
+        for job in self._jobs:
+            if self.auth:
+                job.dl.set_base_auth_info(self.auth)
+        self.progress.reset(0)
+        threads = []
+        for i in range(min(self.threadnum, max(len(self._jobs), 1) * self.per_host)):
+            t = threading.Thread(target=self._worker, kwargs={'idx': i})
+            t.start()
+            threads.append(t)
+        timer = RepeatTimer(PROGRESS_INTERVAL, self._print_progress)
+        timer.start()
+        for t in threads:
+            t.join()
+        timer.cancel()
+        timer.join()
+        self._print_progress()
+        logger.info('Connection pool stats: %s' % self.http_client.get_pool_stats())
+        return dict((job.dl.dstfile, job.result) for job in self._jobs)
+
+    def _worker(self, idx):
+        buf = bytearray(READ_LEN)
+        while True:
+            task = self._next_task(idx)
+            if task is None:
+                break
+            job, chunk = task
+            try:
+                if chunk is None:
+                    self._prepare_job(job)
+                else:
+                    self._fetch_chunk(idx, job, chunk, buf)
+            finally:
+                self._release(job, chunk)
+
+    def _next_task(self, idx):
+        '''轮询各任务，取出一个所属host未达上限的任务：(job, None)表示探测并准备文件，(job, chunk)表示下载块'''
+        with self._cond:
+            while True:
+                jobs = [job for job in self._jobs if job.result is None]
+                if not jobs:
+                    return None
+                self._rr = (self._rr + 1) % len(jobs)
+                for job in jobs[self._rr:] + jobs[:self._rr]:
+                    if self._inflight[job.host] >= self.per_host:
+                        continue
+                    if job.state == 'new':
+                        job.state = 'preparing'
+                    elif job.state == 'running':
+                        chunk = job.dl._scheduler.next(idx)
+                        if chunk is None:
+                            continue
+                        job.active += 1
+                        self._inflight[job.host] += 1
+                        return job, chunk
+                    else:
+                        continue
+                    self._inflight[job.host] += 1
+                    return job, None
+                self._cond.wait(0.5)
+
+    def _prepare_job(self, job):
+        dl = job.dl
+        try:
+            dl._prepare(self.split_size)
+        except Exception as e:
+            logger.error('Prepare download %s error: %s' % (dl.url, e), logtrace=True)
+            job.state, job.result = 'done', False
+            return
+        self.progress.extend(dl.filesize, dl.recv_bytes)
+        job.state = 'running'
+
+    def _fetch_chunk(self, idx, job, chunk, buf):
+        dl = job.dl
+        try:
+            dl._fetch_chunk(chunk, buf)
+        except Exception as e:
+            logger.error('Download %s chunk %d-%d error: %s' % (dl.url, chunk.start, chunk.end, e), logtrace=False)
+            if not dl._scheduler.retry(chunk):
+                dl._failed = True
+        else:
+            dl._scheduler.finish(chunk)
+
+    def _release(self, job, chunk):
+        dl, finish = job.dl, False
+        with self._cond:
+            self._inflight[job.host] -= 1
+            if chunk is not None:
+                job.active -= 1
+            if job.state == 'running' and job.active == 0 and \
+                    (dl._scheduler.idle() or dl._scheduler.failed or dl._failed):
+                # 由当前线程负责收尾，其他线程不会再领取该任务的块
+                job.state, finish = 'finishing', True
+            self._cond.notify_all()
+        if not finish:
+            return
+
+        # 关闭文件、校验摘要等耗时操作在锁外进行，不阻塞其他任务的调度
+        try:
+            result = dl._finish()
+        except Exception as e:
+            logger.error('Finish download %s error: %s' % (dl.url, e), logtrace=True)
+            result = False
+        logger.info('Download %s %s' % (dl.dstfile, 'finished' if result else 'failed'))
+        with self._cond:
+            job.state, job.result = 'done', result
+            self._cond.notify_all()
+
     def _print_progress(self):
-        progress = self.recv_bytes * 100 / self.filesize
-        logger.info('Download progress: %2d%%, %d/%d' % (progress, self.recv_bytes, self.filesize))
+        s = self.progress.sample()
+        done = len([job for job in self._jobs if job.result is not None])
+        logger.info('Download files: %d/%d, %d/%d bytes, speed: %.1f KB/s, avg: %.1f KB/s' % (
+            done, len(self._jobs), s['recv_bytes'], s['total_size'], s['speed'] / 1024, s['avg_speed'] / 1024))
+
+
+class _DownloadJob(object):
+    def __init__(self, dl, host):
+        self.dl = dl
+        self.host = host
+        self.state = 'new'  # new -> preparing -> running -> finishing -> done
+        self.active = 0     # 正在下载的块数
+        self.result = None
 
 
 if __name__ == '__main__':
     import sys, time
-    # downloader.py http://10.46.150.101:8080/test.zip test.zip 30
-    if len(sys.argv) < 4:
-        print 'Usage: %s url dstfile threadnum [timeout]' % sys.argv[0]
+    # downloader.py [--resume] http://10.46.150.101:8080/test.zip test.zip 30
+    # downloader.py [--resume] --list jobs.txt 30    (jobs.txt每行为: url dstfile)
+    # 可选参数: --resume 断点续传, --checksum=sha256:ab12... 校验文件摘要
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--') or arg == '--list']
+    resume = '--resume' in sys.argv
+    checksum = ([arg.split('=', 1)[1] for arg in sys.argv if arg.startswith('--checksum=')] or [None])[0]
+    if len(args) < 3 and not (len(args) >= 2 and args[0] == '--list'):
+        print 'Usage: %s [--resume] [--checksum=alg:hex] url dstfile threadnum [timeout]' % sys.argv[0]
+        print '       %s [--resume] --list jobs_file threadnum [timeout]' % sys.argv[0]
         exit(0)
 
-    url, dstfile, threadnum = sys.argv[1:4]
-    timeout = sys.argv[4:5] or None
     start = time.time()
-    dl = MultiThreadDownloader(url, dstfile, threadnum, timeout)
-    dl.set_base_auth_info(('user', 'pwd'))
-    dl.download()
+    if args[0] == '--list':
+        jobs_file, threadnum = args[1:3] if len(args) > 2 else (args[1], 10)
+        timeout = args[3] if len(args) > 3 else None
+        manager = DownloadManager(threadnum, timeout=timeout, resume=resume)
+        manager.set_base_auth_info(('user', 'pwd'))
+        with open(jobs_file) as fp:
+            for line in fp:
+                if line.strip() and not line.startswith('#'):
+                    manager.add(*line.split()[:2])
+        manager.download()
+    else:
+        url, dstfile, threadnum = args[0:3]
+        timeout = args[3] if len(args) > 3 else None
+        dl = MultiThreadDownloader(url, dstfile, threadnum, timeout, resume=resume, checksum=checksum)
+        dl.set_base_auth_info(('user', 'pwd'))
+        dl.download()
     end = time.time()
     print '\ncost time: %ds' % (end - start)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'JiaSong'
+
+# 结构化JSON行日志：每条日志一行JSON(ts/level/file/line/msg)，
+# 同时维护按时间和按级别的二进制索引文件，查询时可以直接定位到时间窗口或错误日志，无需扫描整个文件
+
+import os
+import sys
+import json
+import time
+import bisect
+import struct
+import logging
+
+TIME_INDEX_SUFFIX = '.tidx'     # 时间索引: 每INDEX_INTERVAL条日志记录一次(时间戳, 偏移)
+LEVEL_INDEX_SUFFIX = '.lidx'    # 级别索引: 每条级别不低于LEVEL_INDEX_MIN的日志记录(时间戳, 偏移, 级别)
+TIME_INDEX_ENTRY = struct.Struct('<dQ')
+LEVEL_INDEX_ENTRY = struct.Struct('<dQH')
+INDEX_INTERVAL = 256
+LEVEL_INDEX_MIN = logging.WARN
+TRACE = logging.DEBUG // 2      # 与logger模块的TRACE级别一致
+
+logging.addLevelName(TRACE, 'TRACE')
+
+
+def _index_files(filename):
+    return filename + TIME_INDEX_SUFFIX, filename + LEVEL_INDEX_SUFFIX
+
+
+class JsonLinesHandler(logging.Handler):
+    '''
+    写JSON行日志及其索引文件的handler，maxBytes > 0时按大小回滚，索引文件随日志文件一起回滚
+    记录中的src_file/src_line/src_msg/src_exc(由logger模块通过extra传入)优先于LogRecord自身的位置信息
+    '''
+
+    def __init__(self, filename, maxBytes=0, backupCount=0):
+        logging.Handler.__init__(self)
+        self.baseFilename = os.path.abspath(filename)
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self._open()
+
+    def _open(self):
+        dirpath = os.path.dirname(self.baseFilename)
+        os.path.exists(dirpath) or os.makedirs(dirpath)
+        tidx, lidx = _index_files(self.baseFilename)
+        self.stream = open(self.baseFilename, 'ab')
+        self.stream.seek(0, os.SEEK_END)
+        self.offset = self.stream.tell()
+        self.tidx = open(tidx, 'ab')
+        self.lidx = open(lidx, 'ab')
+        self.count = 0
+
+    def _close_files(self):
+        for fp in (self.stream, self.tidx, self.lidx):
+            if fp:
+                fp.close()
+        self.stream = self.tidx = self.lidx = None
+
+    def doRollover(self):
+        # 与RotatingFileHandler相同：x -> x.1 -> x.2 ...，索引文件为x.1.tidx、x.1.lidx
+        self._close_files()
+        for suffix in ('', TIME_INDEX_SUFFIX, LEVEL_INDEX_SUFFIX):
+            name = lambda i: '%s.%d%s' % (self.baseFilename, i, suffix) if i else self.baseFilename + suffix
+            for i in xrange(self.backupCount - 1, -1, -1):
+                if os.path.exists(name(i)):
+                    if os.path.exists(name(i + 1)):
+                        os.remove(name(i + 1))
+                    os.rename(name(i), name(i + 1))
+            if not self.backupCount and os.path.exists(name(0)):
+                os.remove(name(0))
+        self._open()
+
+    def format_record(self, record):
+        data = {
+            'ts': record.created,
+            'level': record.levelname,
+            'file': getattr(record, 'src_file', record.filename),
+            'line': getattr(record, 'src_line', record.lineno),
+            'msg': getattr(record, 'src_msg', None) or record.getMessage(),
+        }
+        exc = getattr(record, 'src_exc', None)
+        if not exc and record.exc_info:
+            exc = logging.Formatter().formatException(record.exc_info)
+        if exc:
+            data['exc'] = exc
+        return json.dumps(data, separators=(',', ':'), sort_keys=True) + '\n'
+
+    def emit(self, record):
+        try:
+            line = self.format_record(record)
+            self.acquire()
+            try:
+                if self.maxBytes > 0 and self.offset and self.offset + len(line) > self.maxBytes:
+                    self.doRollover()
+                # 先写日志行再写索引，索引项指向的总是完整写出的行
+                offset = self.offset
+                self.stream.write(line)
+                self.stream.flush()
+                self.offset += len(line)
+                if self.count % INDEX_INTERVAL == 0:
+                    self.tidx.write(TIME_INDEX_ENTRY.pack(record.created, offset))
+                    self.tidx.flush()
+                if record.levelno >= LEVEL_INDEX_MIN:
+                    self.lidx.write(LEVEL_INDEX_ENTRY.pack(record.created, offset, record.levelno))
+                    self.lidx.flush()
+                self.count += 1
+            finally:
+                self.release()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def close(self):
+        self.acquire()
+        try:
+            self._close_files()
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+def _read_entries(path, entry):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    # 忽略写了一半的末尾记录
+    count = len(data) // entry.size
+    return [entry.unpack_from(data, i * entry.size) for i in xrange(count)]
+
+
+def level_number(level):
+    '''将级别名称(如'ERROR'、'TRACE')或数值转换为数值级别，未知名称抛出ValueError'''
+    if isinstance(level, (int, long)):
+        return level
+    name = str(level).upper()
+    number = logging.getLevelName(name)
+    if not isinstance(number, (int, long)):
+        # 未注册的数值级别记录为"Level N"
+        if name.startswith('LEVEL ') and name[6:].isdigit():
+            return int(name[6:])
+        raise ValueError('Unknown log level: {}'.format(level))
+    return number
+
+
+def _start_offset(filename, start):
+    '''根据时间索引找到不晚于start的最后一个索引点的偏移'''
+    if start is None:
+        return 0
+    entries = _read_entries(_index_files(filename)[0], TIME_INDEX_ENTRY)
+    pos = bisect.bisect_left([ts for ts, _ in entries], start)
+    return entries[pos - 1][1] if pos > 0 else 0
+
+
+def query(filename, start=None, end=None, level=None, keyword=None, limit=0):
+    '''
+    查询JSON行日志，返回按时间顺序的日志字典列表
+    start/end 时间窗口(epoch秒)，level 最低级别(名称或数值)，keyword 消息中包含的文本，limit 最多返回条数
+    level不低于LEVEL_INDEX_MIN时只读取级别索引指向的记录，否则借助时间索引从窗口起点开始扫描
+    '''
+    if level is not None:
+        level = level_number(level)
+    if isinstance(keyword, str):
+        keyword = keyword.decode('utf-8')
+    results = []
+
+    def accept(item):
+        if start is not None and item['ts'] < start:
+            return True
+        if end is not None and item['ts'] > end:
+            return True
+        if keyword and keyword not in item['msg']:
+            return True
+        results.append(item)
+        return not limit or len(results) < limit
+
+    with open(filename, 'rb') as fp:
+        if level is not None and level >= LEVEL_INDEX_MIN:
+            for ts, offset, levelno in _read_entries(_index_files(filename)[1], LEVEL_INDEX_ENTRY):
+                if levelno < level or (start is not None and ts < start):
+                    continue
+                if end is not None and ts > end:
+                    break
+                fp.seek(offset)
+                try:
+                    item = json.loads(fp.readline())
+                except ValueError:
+                    # 崩溃或并发写入时可能是不完整的行
+                    continue
+                if not accept(item):
+                    break
+        else:
+            fp.seek(_start_offset(filename, start))
+            for line in fp:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                if end is not None and item['ts'] > end:
+                    break
+                if level is not None and level_number(item['level']) < level:
+                    continue
+                if not accept(item):
+                    break
+    return results
+
+
+def _parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return time.mktime(time.strptime(value, '%Y-%m-%d %H:%M:%S'))
+
+
+def _format_item(item):
+    ts = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(item['ts']))
+    text = u'{}.{:03d} *{}* {} -- [{}:{}]'.format(
+        ts, int(item['ts'] * 1000) % 1000, item['level'], item['msg'], item['file'], item['line'])
+    if item.get('exc'):
+        text += u'\n' + item['exc']
+    return text.encode('utf-8')
+
+
+if __name__ == '__main__':
+    # jsonlog.py [--start="2016-05-01 10:00:00"] [--end=...] [--level=ERROR] [--grep=text] [--limit=N] logfile [logfile ...]
+    opts = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+    files = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if not files:
+        print 'Usage: %s [--start=time] [--end=time] [--level=LEVEL] [--grep=text] [--limit=N] logfile [logfile ...]' % sys.argv[0]
+        print '       time format: "YYYY-mm-dd HH:MM:SS" or epoch seconds'
+        exit(0)
+
+    start = _parse_time(opts['start']) if 'start' in opts else None
+    end = _parse_time(opts['end']) if 'end' in opts else None
+    limit = int(opts.get('limit', 0))
+    try:
+        level = level_number(opts['level']) if 'level' in opts else None
+    except ValueError, e:
+        print >>sys.stderr, e
+        exit(1)
+    for filename in files:
+        if not os.path.exists(filename):
+            print >>sys.stderr, 'Log file <%s> not found, skipped' % filename
+            continue
+        items = query(filename, start, end, level, opts.get('grep'), limit)
+        for item in items:
+            print _format_item(item)
+        if limit:
+            limit -= len(items)
+            if limit <= 0:
+                break
@@ -3,12 +3,34 @@
 __author__ = 'JiaSong'
 
 import os
+import sys
 import logging
 from logging.handlers import RotatingFileHandler
 import traceback
-import inspect
+import threading
+import atexit
+import Queue
+import jsonlog
+
+LEVELS = {
+    'TRACE': logging.DEBUG // 2,
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'HTML': logging.INFO,
+    'WARN': logging.WARN,
+    'ERROR': logging.ERROR
+}
+
+ASYNC_QUEUE_SIZE = 10000  # 异步模式下日志队列的默认长度
+ASYNC_BATCH_SIZE = 256    # 后台线程每批最多写出的日志条数
 
 logger = None
+_json_handler = None      # 结构化JSON行日志handler
+_async_writer = None      # 异步写日志线程，为None时同步输出
+_level = LEVELS['TRACE']  # 日志输出阈值，低于该级别的日志直接丢弃
+_OPTIONS = frozenset(['also_file', 'logtrace'])  # 日志函数支持的关键字参数
+_capture_caller = True  # 是否在日志中记录调用位置[文件名:行号]
+_basenames = {}         # 代码对象 -> 文件名，避免每次调用都计算basename
 
 
 def _cur_dir():
@@ -33,6 +55,27 @@ def _get_logger():
     return logger
 
 
+def enable_json_log(filename=None, maxBytes=10 << 20, backupCount=5):
+    '''
+    为写文件的日志(also_file=True)增加结构化JSON行输出，默认写到log/RobotFramework.jsonl，
+    可用 python jsonlog.py 按时间窗口或级别查询
+    '''
+    global _json_handler
+    disable_json_log()
+    logging.addLevelName(LEVELS['TRACE'], 'TRACE')
+    filename = filename or _cur_dir() + 'log/RobotFramework.jsonl'
+    _json_handler = jsonlog.JsonLinesHandler(filename, maxBytes, backupCount)
+    _get_logger().addHandler(_json_handler)
+
+
+def disable_json_log():
+    global _json_handler
+    handler, _json_handler = _json_handler, None
+    if handler:
+        _get_logger().removeHandler(handler)
+        handler.close()
+
+
 def get_trace_info(logtrace):
     trace = ''
     if logtrace:
@@ -41,40 +84,254 @@ def get_trace_info(logtrace):
     return trace
 
 
-def _write(msg, level='INFO', also_file=False, logtrace=False):
-    exc_str = get_trace_info(logtrace)
-    _, filepath, lineno, _, _, _ = inspect.stack()[2]
-    filename = os.path.basename(filepath)
-    fmt_msg = '{} -- [{}:{}]{}'.format(msg, filename, lineno, exc_str)
+def set_level(level):
+    '''设置日志输出阈值，level可以是级别名称(如'INFO')或logging数值级别'''
+    global _level
+    _level = LEVELS[level.upper()] if isinstance(level, basestring) else int(level)
+
+
+def is_enabled(level):
+    '''判断指定级别的日志是否会被输出，用于在构造开销较大的日志前预先判断'''
+    if isinstance(level, basestring):
+        level = LEVELS[level.upper()]
+    return level >= _level
+
+
+def _format_msg(msg, args):
+    '''仅在日志确实输出时才格式化：msg可为可调用对象，args按%方式格式化'''
+    if callable(msg):
+        msg = msg()
+    if args:
+        msg = msg % args
+    return msg
+
+
+def set_capture_caller(enable=True):
+    '''设置是否在日志中记录调用位置，关闭后不再访问调用栈'''
+    global _capture_caller
+    _capture_caller = bool(enable)
+
+
+def _caller_location(depth):
+    '''返回调用栈中第depth层(相对调用方)的(文件名, 行号)'''
+    frame = sys._getframe(depth + 1)
+    code = frame.f_code
+    filename = _basenames.get(code)
+    if filename is None:
+        filename = _basenames[code] = os.path.basename(code.co_filename)
+    return filename, frame.f_lineno
+
+
+class _AsyncWriter(threading.Thread):
+    '''后台写日志线程，从有界队列中批量取出日志并输出'''
+
+    def __init__(self, maxsize, block, batch):
+        threading.Thread.__init__(self, name='logger-writer')
+        self.daemon = True
+        self.queue = Queue.Queue(maxsize)
+        self.block = block
+        self.batch = max(1, batch)
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0     # 输出时出错而丢失的条数
+        self.max_depth = 0
+        self._lock = threading.Lock()
+
+    def put(self, record):
+        '''日志入队，队列满时根据block参数阻塞等待或丢弃'''
+        try:
+            self.queue.put(record, self.block)
+        except Queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.batch:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = None in records
+            records = [r for r in records if r is not None]
+            try:
+                _emit_batch(records)
+                self.written += len(records)
+            except Exception:
+                self.failed += len(records)
+                self._report_error(len(records))
+            for _ in xrange(len(records) + (1 if stop else 0)):
+                self.queue.task_done()
+            if stop:
+                break
+
+    def _report_error(self, count):
+        '''与logging.Handler.handleError一致，把异常信息打印到stderr'''
+        if logging.raiseExceptions and sys.stderr:
+            try:
+                sys.stderr.write('Logger: failed to write {} records\n'.format(count))
+                traceback.print_exc(file=sys.stderr)
+            except IOError:
+                pass
+
+    def flush(self):
+        '''等待队列中已有的日志全部写出'''
+        self.queue.join()
+
+    def stop(self):
+        '''写完队列中剩余日志后退出线程'''
+        self.queue.put(None)
+        self.join()
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'max_depth': self.max_depth,
+            'maxsize': self.maxsize,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed
+        }
+
+
+def enable_async(maxsize=ASYNC_QUEUE_SIZE, block=False, batch=ASYNC_BATCH_SIZE):
+    '''
+    开启异步日志模式：日志格式化后放入有界队列，由后台线程批量写到stdout和日志文件
+    maxsize 队列长度，block 队列满时是否阻塞等待(否则丢弃并计数)，batch 每批最多写出条数
+    '''
+    global _async_writer
+    disable_async()
+    writer = _AsyncWriter(maxsize, block, batch)
+    writer.start()
+    _async_writer = writer
+
+
+def disable_async():
+    '''关闭异步日志模式，写完队列中剩余日志后恢复同步输出'''
+    global _async_writer
+    writer, _async_writer = _async_writer, None
+    if writer:
+        writer.stop()
+
+
+def flush():
+    '''异步模式下等待已入队的日志全部写出'''
+    writer = _async_writer
+    if writer:
+        writer.flush()
+
+
+def get_async_stats():
+    '''返回异步模式统计信息：当前队列深度、最大深度、已写出、丢弃及写出失败的条数'''
+    writer = _async_writer
+    return writer.stats() if writer else None
+
+
+atexit.register(disable_async)
+
+
+def _emit(level, fmt_msg, extra):
     print '*{}* {}'.format(level, fmt_msg)
-    if also_file:
+    if extra is not None:
         logger = _get_logger()
-        level = {
-            'TRACE': logging.DEBUG // 2,
-            'DEBUG': logging.DEBUG,
-            'INFO': logging.INFO,
-            'HTML': logging.INFO,
-            'WARN': logging.WARN,
-            'ERROR': logging.ERROR
-        }[level]
-        logger.log(level, fmt_msg)
+        logger.log(LEVELS[level], fmt_msg, extra=extra)
+
+
+def _emit_batch(records):
+    sys.stdout.write(''.join('*{}* {}\n'.format(level, fmt_msg) for level, fmt_msg, _ in records))
+    sys.stdout.flush()
+    for level, fmt_msg, extra in records:
+        if extra is not None:
+            logger = _get_logger()
+            logger.log(LEVELS[level], fmt_msg, extra=extra)
+
+
+def _write(msg, args, also_file=False, logtrace=False, level='INFO'):
+    msg = _format_msg(msg, args)
+    exc_str = get_trace_info(logtrace)
+    # 写文件时通过extra附带调用位置和原始消息，供结构化日志使用
+    extra = {'src_msg': msg, 'src_exc': exc_str.strip()} if also_file else None
+    if _capture_caller:
+        filename, lineno = _caller_location(2)
+        fmt_msg = '{} -- [{}:{}]{}'.format(msg, filename, lineno, exc_str)
+        if extra is not None:
+            extra['src_file'], extra['src_line'] = filename, lineno
+    else:
+        fmt_msg = '{}{}'.format(msg, exc_str)
+    writer = _async_writer
+    if writer:
+        writer.put((level, fmt_msg, extra))
+    else:
+        _emit(level, fmt_msg, extra)
+
+
+def _options(msg, args, kwargs, logtrace=False):
+    '''
+    解析日志函数的参数，返回(格式化参数, also_file, logtrace)
+    兼容旧接口的位置参数 info(msg, also_file, logtrace)：args只有1~2个且msg不能用它们格式化
+    (如msg中没有格式占位符)时，按真假值作为also_file、logtrace处理，如info(msg, None)、info(msg, 1)
+    '''
+    also_file = False
+    if args and len(args) <= 2 and isinstance(msg, basestring) and not _formats(msg, args):
+        if len(args) > 1:
+            logtrace = bool(args[1])
+        also_file, args = bool(args[0]), ()
+    if kwargs:
+        also_file = kwargs.get('also_file', also_file)
+        logtrace = kwargs.get('logtrace', logtrace)
+    return args, also_file, logtrace
+
+
+def _check_options(kwargs):
+    unknown = set(kwargs) - _OPTIONS
+    if unknown:
+        raise TypeError('unexpected keyword argument(s): {}'.format(', '.join(sorted(unknown))))
+
+
+def _formats(msg, args):
+    try:
+        msg % args
+    except (TypeError, ValueError):
+        return False
+    return True
 
 
-def trace(msg, also_file=False, logtrace=False):
-    _write(msg, 'TRACE', also_file, logtrace)
+def trace(msg, *args, **kwargs):
+    if kwargs:
+        _check_options(kwargs)
+    if LEVELS['TRACE'] >= _level:
+        _write(msg, *_options(msg, args, kwargs), level='TRACE')
 
 
-def debug(msg, also_file=False, logtrace=False):
-    _write(msg, 'DEBUG', also_file, logtrace)
+def debug(msg, *args, **kwargs):
+    if kwargs:
+        _check_options(kwargs)
+    if LEVELS['DEBUG'] >= _level:
+        _write(msg, *_options(msg, args, kwargs), level='DEBUG')
 
 
-def info(msg, also_file=False, logtrace=False):
-    _write(msg, 'INFO', also_file, logtrace)
+def info(msg, *args, **kwargs):
+    if kwargs:
+        _check_options(kwargs)
+    if LEVELS['INFO'] >= _level:
+        _write(msg, *_options(msg, args, kwargs), level='INFO')
 
 
-def warn(msg, also_file=False, logtrace=False):
-    _write(msg, 'WARN', also_file, logtrace)
+def warn(msg, *args, **kwargs):
+    if kwargs:
+        _check_options(kwargs)
+    if LEVELS['WARN'] >= _level:
+        _write(msg, *_options(msg, args, kwargs), level='WARN')
 
 
-def error(msg, also_file=False, logtrace=True):
-    _write(msg, 'ERROR', also_file, logtrace)
+def error(msg, *args, **kwargs):
+    if kwargs:
+        _check_options(kwargs)
+    if LEVELS['ERROR'] >= _level:
+        _write(msg, *_options(msg, args, kwargs, logtrace=True), level='ERROR')
@@ -4,23 +4,85 @@
 # 多进程安全的午夜自动切分回滚日志类，
 # 解决TimedRotatingFileHandler多进程场景下可能导致先前回滚的存档日志被其他进程的回滚操作覆盖的问题
 
+import logging
 from logging import FileHandler
-import os, re, errno, stat, datetime
+import os, sys, re, errno, stat, datetime, time, fcntl, threading, traceback
+
+# 单调时钟，用于低开销地判断是否到达切分时间；Python2没有time.monotonic时退化为time.time
+_monotonic = getattr(time, 'monotonic', time.time)
+
+SHARED_WRITE_SIZE = 4096   # 共享模式下批量写入时单次write的最大字节数(整条日志不拆分)
+CLEAN_LOOKBACK_DAYS = 7    # 共享模式下清理过期日志时向前检查的天数
+
+
+class _AppendStream(object):
+    """以O_APPEND方式打开的文件，每次write对应一次os.write，多进程追加写不会互相覆盖"""
+
+    def __init__(self, filename, encoding=None):
+        self.fd = os.open(filename, os.O_WRONLY | os.O_APPEND)
+        self.encoding = encoding or 'utf-8'
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode(self.encoding)
+        while data:
+            n = os.write(self.fd, data)
+            data = data[n:]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
 
 
 class MidnightRotatingFileHandler(FileHandler):
-    def __init__(self, filename, backupCount=0, encoding=None, delay=False):
+    """
+    bufferSize > 0 时开启缓冲模式：日志先缓存在内存中，累计达到bufferSize字节时一次性写入文件，
+    另有后台线程每flushInterval秒写出一次缓存，日志停止后缓存也不会长期滞留在内存中，
+    handler关闭或切分时会先写出缓存
+
+    shared=True 时开启多进程共享模式：各进程以O_APPEND方式写同一个日志文件，每条日志一次write；
+    切分时通过锁文件(filename + '.lock')协调，每天只由一个进程清理过期日志并更新软链接，
+    清理时只检查预期的日期文件名，不再遍历目录
+    """
+    def __init__(self, filename, backupCount=0, encoding=None, delay=False,
+                 bufferSize=0, flushInterval=1.0, shared=False):
         self._filename = filename
+        self._shared = shared
+        self._lockFile = filename + '.lock'
         self._backupCount = backupCount
-        self._rotateAt = self._getNextRotateTime()
+        self._setRotateTime()
         self._extMatch = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+        self._bufferSize = bufferSize
+        self._flushInterval = flushInterval
+        self._flusher = None
+        self._flusherStop = None
+        self._buffer = []
+        self._bufferLen = 0
         FileHandler.__init__(self, filename, 'a', encoding, delay)
 
     @staticmethod
     def _getNextRotateTime():
-        # rotate at midnight
-        now = datetime.datetime.now()
-        return now.replace(hour=0, minute=0, second=0) + datetime.timedelta(days=1)
+        # rotate at midnight, return epoch seconds
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        return time.mktime(tomorrow.timetuple())
+
+    def _setRotateTime(self):
+        # 缓存切分时间点(epoch)及对应的单调时钟截止时间，emit时只需比较一次单调时钟
+        self._rotateAt = self._getNextRotateTime()
+        self._rotateDeadline = _monotonic() + (self._rotateAt - time.time())
+
+    def _shouldRotate(self):
+        if _monotonic() < self._rotateDeadline:
+            return False
+        # 单调时钟到期后以墙上时间为准复核，处理系统时间被调整的情况
+        if time.time() >= self._rotateAt:
+            return True
+        self._rotateDeadline = _monotonic() + (self._rotateAt - time.time())
+        return False
 
     def _open(self):
         now = datetime.datetime.now()
@@ -35,20 +97,133 @@ class MidnightRotatingFileHandler(FileHandler):
                 # should not happen
                 raise
         self.baseFilename = log_today
+        if self._shared:
+            self._sharedHousekeeping(log_today)
+            return _AppendStream(log_today, self.encoding)
         self._makeSymLink(log_today)
         return FileHandler._open(self)
 
+    def _sharedHousekeeping(self, log_today):
+        # 持有锁文件的进程检查锁文件中记录的日期，当天尚未处理时清理过期日志并更新软链接
+        fd = os.open(self._lockFile, os.O_RDWR|os.O_CREAT, stat.S_IWUSR|stat.S_IRUSR|stat.S_IRGRP|stat.S_IROTH)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.read(fd, 4096) == log_today and os.path.islink(self._filename):
+                return
+            self._tryCleanFiles()
+            self._makeSymLink(log_today)
+            os.ftruncate(fd, 0)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, log_today)
+        finally:
+            # closing the fd releases the flock
+            os.close(fd)
+
     def emit(self, record):
-        now = datetime.datetime.now()
-        if now > self._rotateAt:
+        if self._shouldRotate():
             # time to rotate
-            self._rotateAt = self._getNextRotateTime()
+            self._setRotateTime()
             self.close()
-            self._tryCleanFiles()
+            if not self._shared:
+                self._tryCleanFiles()
 
-        FileHandler.emit(self, record)
+        if self._bufferSize > 0:
+            self._bufferRecord(record)
+        else:
+            FileHandler.emit(self, record)
+
+    def _bufferRecord(self, record):
+        try:
+            msg = self.format(record)
+            if isinstance(msg, unicode) and not self.encoding:
+                msg = msg.encode('utf-8')
+            self._buffer.append(msg + '\n')
+            self._bufferLen += len(msg) + 1
+            if self._flusher is None or not self._flusher.is_alive():
+                self._startFlusher()
+            if self._bufferLen >= self._bufferSize:
+                self.flush()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def _startFlusher(self):
+        # 首次缓存日志时启动；fork出的子进程中线程已不存在，会重新启动
+        self._flusherStop = threading.Event()
+        self._flusher = threading.Thread(target=self._flushLoop, args=(self._flusherStop,),
+                                         name='mplog-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _flushLoop(self, stopped):
+        # 用sleep而不是stopped.wait：close(包括退出时的logging.shutdown)不会立刻唤醒线程，
+        # 避免守护线程在解释器退出过程中运行；close后最多一个周期线程自行退出
+        while True:
+            time.sleep(self._flushInterval)
+            if stopped.is_set():
+                return
+            if not self._buffer:
+                continue
+            self.acquire()
+            try:
+                # 与close竞争时，close之后不再写出(否则会重新打开文件)
+                if not stopped.is_set():
+                    self.flush()
+            except Exception:
+                if logging.raiseExceptions and sys.stderr:
+                    traceback.print_exc(file=sys.stderr)
+            finally:
+                self.release()
+
+    def flush(self):
+        if self._bufferSize <= 0:
+            # 非缓冲模式下每条日志都会调用flush，保持与FileHandler相同的开销
+            return FileHandler.flush(self)
+        self.acquire()
+        try:
+            if self._buffer:
+                if self.stream is None:
+                    self.stream = self._open()
+                self._writeBuffer()
+                del self._buffer[:]
+                self._bufferLen = 0
+            if self.stream and hasattr(self.stream, "flush"):
+                self.stream.flush()
+        finally:
+            self.release()
+
+    def _writeBuffer(self):
+        if not self._shared:
+            self.stream.write(''.join(self._buffer))
+            return
+        # 共享模式下按整条日志分组写入，每组一次write，避免与其他进程的日志交错
+        group, size = [], 0
+        for msg in self._buffer:
+            if group and size + len(msg) > SHARED_WRITE_SIZE:
+                self.stream.write(''.join(group))
+                group, size = [], 0
+            group.append(msg)
+            size += len(msg)
+        if group:
+            self.stream.write(''.join(group))
+
+    def close(self):
+        self.acquire()
+        try:
+            if self._buffer:
+                self.flush()
+            if self._flusherStop is not None:
+                # logging.shutdown持有锁调用close，不能在此join；切分后缓存新日志时会重新启动
+                self._flusherStop.set()
+                self._flusher = self._flusherStop = None
+            FileHandler.close(self)
+        finally:
+            self.release()
 
     def getFilesToDelete(self):
+        if self._shared:
+            return self._getExpiredFiles()
         dirName, baseName = os.path.split(self._filename)
         result = []
         prefix = baseName + "."
@@ -65,12 +240,28 @@ class MidnightRotatingFileHandler(FileHandler):
             result = result[:len(result) - self._backupCount]
         return result
 
+    def _getExpiredFiles(self):
+        # 保留最近backupCount天的日志，只检查更早的CLEAN_LOOKBACK_DAYS个日期文件名是否存在
+        today = datetime.date.today()
+        result = []
+        for days in xrange(self._backupCount + 1, self._backupCount + 1 + CLEAN_LOOKBACK_DAYS):
+            day = today - datetime.timedelta(days=days)
+            fileName = "%s.%s" % (self._filename, day.strftime('%Y-%m-%d'))
+            if os.path.exists(fileName):
+                result.append(fileName)
+        return result
+
     def _tryCleanFiles(self):
         if 0 == self._backupCount:
             return
 
         for s in self.getFilesToDelete():
-            os.remove(s)
+            try:
+                os.remove(s)
+            except OSError as e:
+                # another process may have removed it already
+                if e.errno != errno.ENOENT:
+                    raise
 
     def _makeSymLink(self, srcFile):
         try:
@@ -83,7 +274,7 @@ class MidnightRotatingFileHandler(FileHandler):
 if __name__ == "__main__":
     import logging, time
     log = logging.getLogger('test')
-    h = MidnightRotatingFileHandler('/tmp/log/test.log', backupCount=3)
+    h = MidnightRotatingFileHandler('/tmp/log/test.log', backupCount=3, bufferSize=4096)
     f = logging.Formatter('%(asctime)s [%(threadName)s] %(message)s -- [%(levelname)s][%(filename)s:%(lineno)d]')
     h.setFormatter( f )
     log.addHandler( h )